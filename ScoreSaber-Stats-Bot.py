@@ -2,10 +2,27 @@
 # ScoreSaber Stats Bot, developed by 0xDEADCADE
 # ScoreSaber Stats Bot is a Discord bot that sends updates about statistics on ScoreSaber users
 import discord
+import inspect
 import json
 import random
-import requests
+import aiohttp
 import asyncio
+import contextvars
+import hashlib
+import heapq
+import mmap
+import os
+import signal
+import sqlite3
+import struct
+import subprocess
+import sys
+import time
+import weakref
+import zlib
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from discord.http import Route
 
 # Important notes for maintainers
 # Umbranox does not like API requests
@@ -21,8 +38,14 @@ import asyncio
 # Indicate whether the bot has been started yet.
 StatUpdateRunning = False
 StatusUpdateRunning = False
-# Indicate whether currently the stats are being updated
-IsUpdating = False
+MetricsRunning = False
+LeaderboardRunning = False
+# Restoring the state saved before the last restart, once started
+StateRestore = None
+# Whether this process is a poller worker started with --poll-worker instead of the bot itself
+IsPollWorker = False
+# Name this process polls players under, poller workers use the name they were started with
+WorkerName = "bot"
 
 # Imported Variables
 with open("Settings.json", "r") as f:
@@ -35,6 +58,1166 @@ Token = Settings["Token"]
 SupportServer = Settings["SupportServerURL"]
 ProfilePicture = Settings["PFPURL"]
 SourceURL = Settings["SourceURL"]
+# Where the ScoreSaber API lives, only worth changing to point the bot at a stand-in for testing
+ApiBaseURL = Settings.get("ApiBaseURL", "https://new.scoresaber.com")
+# Seconds before a ScoreSaber request is given up on
+ApiTimeout = Settings.get("ApiTimeout", 15)
+
+# ScoreSaber API budget, shared by every request the bot makes
+ApiRequestsPerMinute = Settings.get("ApiRequestsPerMinute", 20)
+ApiBurst = Settings.get("ApiBurst", 3)
+# How often a request is retried after ScoreSaber answers with 429 Too Many Requests
+ApiMaxRetries = 3
+
+# Request priorities, lower goes first
+# Commands are someone waiting on a reply, the status is cosmetic, polling can always wait
+PriorityCommand = 0
+PriorityStatus = 1
+PriorityPoll = 2
+
+# How long responses are reused for, in seconds, per endpoint
+CacheTTL = Settings.get("CacheTTL", {"basic": 300, "by-name": 3600, "players": 600})
+# Maximum amount of cached responses
+CacheSize = Settings.get("CacheSize", 2000)
+
+# Players are polled in windows of this many seconds, with requests spread evenly over the window
+PollWindow = Settings.get("PollWindow", 600)
+# Bounds on how often a single player is polled, in seconds
+PollIntervalMin = Settings.get("PollIntervalMin", 600)
+PollIntervalMax = Settings.get("PollIntervalMax", 7200)
+# How often inactive or banned players are polled, they're unlikely to change
+PollIntervalInactive = Settings.get("PollIntervalInactive", 86400)
+# Players refreshed from leaderboard pages still get their own request at least this often, pages don't list country rank
+PollIntervalBasic = Settings.get("PollIntervalBasic", 86400)
+
+# Maximum amount of messages being sent to Discord at the same time, each channel sends one at a time
+DeliveryConcurrency = Settings.get("DeliveryConcurrency", 8)
+# Seconds a channel waits before sending, so stat updates that come in around the same time go out in one message
+DeliveryBatchDelay = Settings.get("DeliveryBatchDelay", 2)
+
+# Seconds before a user, or anyone in a channel, can use the same API heavy command again
+CommandCooldownUser = Settings.get("CommandCooldownUser", 5)
+CommandCooldownChannel = Settings.get("CommandCooldownChannel", 2)
+
+# Prometheus text file metrics are written to every MetricsInterval seconds, empty to disable
+MetricsFile = Settings.get("MetricsFile", "metrics.prom")
+MetricsInterval = Settings.get("MetricsInterval", 60)
+
+# Discord gateway shards, null lets Discord decide how many the bot needs
+ShardCount = Settings.get("ShardCount", None)
+# Poller worker processes the bot starts, 0 has the bot poll by itself
+# More can be started by hand with --poll-worker <name>, players are spread over every running worker
+PollWorkers = Settings.get("PollWorkers", 0)
+# Seconds between worker heartbeats, and after which a worker without heartbeats is considered gone
+WorkerHeartbeat = Settings.get("WorkerHeartbeat", 10)
+WorkerTimeout = Settings.get("WorkerTimeout", 30)
+
+# Leaderboard pages (50 players each) kept in memory, and the seconds it takes for all of them to be refreshed once
+LeaderboardPages = Settings.get("LeaderboardPages", 100)
+LeaderboardRefresh = Settings.get("LeaderboardRefresh", 21600)
+
+# Seconds a player name is remembered after it was last seen, names change and get taken by other players
+NameExpiry = Settings.get("NameExpiry", 2592000)
+
+# File the stats history of every player is kept in
+HistoryPath = Settings.get("HistoryPath", "History.bin")
+# Samples kept per player, and the seconds a sample covers, polls within the same period replace each other's sample
+# The defaults keep 90 days of hourly samples, about 35KB per player
+HistorySamples = Settings.get("HistorySamples", 2160)
+HistoryInterval = Settings.get("HistoryInterval", 3600)
+
+# File runtime state (poll schedule, leaderboard index, cached responses) is saved to, so a restart doesn't start from nothing
+# Saved every StateInterval seconds and when the bot stops, empty to disable
+StatePath = Settings.get("StatePath", "State.bin")
+StateInterval = Settings.get("StateInterval", 300)
+
+# SQLite database registrations are stored in
+DatabasePath = Settings.get("DatabasePath", "SSData.db")
+
+# Shared HTTP session, created on first use so it's bound to the bot's event loop
+HttpSession = None
+
+
+# Counters, gauges and latency histograms for finding out where time and API budget go
+# Labels are tuples of (name, value) pairs
+class MetricsRegistry:
+    # Histogram bucket upper bounds, in seconds
+    Buckets = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+
+    def __init__(self):
+        self.Started = time.time()
+        self.Counters = {}
+        self.Gauges = {}
+        # (name, labels): [count per bucket..., count above the last bucket, sum]
+        self.Histograms = {}
+        # name: timestamps of recent events, for per minute rates
+        self.Events = {}
+
+    def Count(self, name, labels=(), value=1):
+        self.Counters[(name, labels)] = self.Counters.get((name, labels), 0) + value
+
+    def Set(self, name, value, labels=()):
+        self.Gauges[(name, labels)] = value
+
+    def Observe(self, name, value, labels=()):
+        histogram = self.Histograms.get((name, labels))
+        if histogram is None:
+            histogram = self.Histograms[(name, labels)] = [0] * (len(self.Buckets) + 2)
+        for n, bound in enumerate(self.Buckets):
+            if value <= bound:
+                histogram[n] += 1
+                break
+        else:
+            histogram[len(self.Buckets)] += 1
+        histogram[-1] += value
+
+    # Records an event for PerMinute
+    def Mark(self, name):
+        events = self.Events.setdefault(name, deque())
+        events.append(time.monotonic())
+
+    # How often an event happened in the last minute
+    def PerMinute(self, name):
+        events = self.Events.get(name, deque())
+        while events and events[0] < time.monotonic() - 60:
+            events.popleft()
+        return len(events)
+
+    # Approximate quantile of a histogram, as the upper bound of the bucket it falls in
+    def Quantile(self, name, labels, q):
+        histogram = self.Histograms.get((name, labels))
+        if histogram is None:
+            return 0
+        total = sum(histogram[:-1])
+        seen = 0
+        for n, bound in enumerate(self.Buckets):
+            seen += histogram[n]
+            if seen >= q * total:
+                return bound
+        return float("inf")
+
+    # Total count and sum of a histogram
+    def Summary(self, name, labels):
+        histogram = self.Histograms.get((name, labels), [0] * (len(self.Buckets) + 2))
+        return sum(histogram[:-1]), histogram[-1]
+
+    # Every label set a metric has been recorded with
+    def LabelsOf(self, name):
+        return sorted({labels for metrics in (self.Counters, self.Gauges, self.Histograms) for (metric, labels) in metrics if metric == name})
+
+    # Renders every metric in the Prometheus text format
+    def Render(self):
+        def Labels(labels, extra=()):
+            labels = labels + extra
+            return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}" if labels else ""
+        lines = []
+        for name in sorted({name for name, labels in self.Counters}):
+            lines.append(f"# TYPE scoresaber_bot_{name} counter")
+            lines += [f"scoresaber_bot_{name}{Labels(labels)} {value}" for (metric, labels), value in sorted(self.Counters.items()) if metric == name]
+        for name in sorted({name for name, labels in self.Gauges}):
+            lines.append(f"# TYPE scoresaber_bot_{name} gauge")
+            lines += [f"scoresaber_bot_{name}{Labels(labels)} {value}" for (metric, labels), value in sorted(self.Gauges.items()) if metric == name]
+        for name in sorted({name for name, labels in self.Histograms}):
+            lines.append(f"# TYPE scoresaber_bot_{name} histogram")
+            for (metric, labels), histogram in sorted(self.Histograms.items()):
+                if metric != name:
+                    continue
+                cumulative = 0
+                for n, bound in enumerate(self.Buckets):
+                    cumulative += histogram[n]
+                    lines.append(f"scoresaber_bot_{name}_bucket{Labels(labels, (('le', bound),))} {cumulative}")
+                cumulative += histogram[len(self.Buckets)]
+                lines.append(f"scoresaber_bot_{name}_bucket{Labels(labels, (('le', '+Inf'),))} {cumulative}")
+                lines.append(f"scoresaber_bot_{name}_sum{Labels(labels)} {histogram[-1]}")
+                lines.append(f"scoresaber_bot_{name}_count{Labels(labels)} {cumulative}")
+        return "\n".join(lines) + "\n"
+
+Metrics = MetricsRegistry()
+
+
+# Token bucket all ScoreSaber requests have to go through
+# Requests wait in a priority queue, and get let through one at a time as tokens become available
+class ApiScheduler:
+    def __init__(self, RequestsPerMinute, Burst):
+        self.RequestsPerMinute = RequestsPerMinute
+        self.Rate = RequestsPerMinute / 60
+        self.Burst = Burst
+        self.Tokens = Burst
+        self.LastRefill = time.monotonic()
+        # ScoreSaber told us to back off until this time
+        self.PausedUntil = 0
+        # Heap of (priority, order, future)
+        self.Waiting = []
+        self.Order = 0
+        self.Wakeup = None
+        self.Task = None
+
+    # Adds tokens for the time passed since the last refill
+    def Refill(self):
+        now = time.monotonic()
+        self.Tokens = min(self.Burst, self.Tokens + (now - self.LastRefill) * self.Rate)
+        self.LastRefill = now
+
+    # Waits until a request with this priority is allowed to be made
+    async def Acquire(self, priority):
+        loop = asyncio.get_event_loop()
+        if self.Task is None or self.Task.done():
+            self.Wakeup = asyncio.Event()
+            self.Task = loop.create_task(self.Dispatch())
+        future = loop.create_future()
+        heapq.heappush(self.Waiting, (priority, self.Order, future))
+        self.Order += 1
+        self.Wakeup.set()
+        start = time.monotonic()
+        await future
+        Metrics.Observe("api_queue_seconds", time.monotonic() - start, (("priority", priority),))
+
+    # Only uses part of the budget, when other processes are making requests from the same IP as well
+    def SetShare(self, share):
+        self.Rate = self.RequestsPerMinute * share / 60
+
+    # Stops handing out tokens for a while, used when ScoreSaber answers with 429
+    def Pause(self, seconds):
+        self.PausedUntil = max(self.PausedUntil, time.monotonic() + seconds)
+        self.Tokens = 0
+
+    # Background task handing out tokens to waiting requests, highest priority first
+    async def Dispatch(self):
+        while True:
+            # Skip requests that were cancelled while waiting
+            while self.Waiting and self.Waiting[0][2].done():
+                heapq.heappop(self.Waiting)
+            if not self.Waiting:
+                self.Wakeup.clear()
+                await self.Wakeup.wait()
+                continue
+            now = time.monotonic()
+            if now < self.PausedUntil:
+                await asyncio.sleep(self.PausedUntil - now)
+                self.LastRefill = time.monotonic()
+                continue
+            self.Refill()
+            if self.Tokens >= 1:
+                self.Tokens -= 1
+                heapq.heappop(self.Waiting)[2].set_result(None)
+            else:
+                await asyncio.sleep((1 - self.Tokens) / self.Rate)
+
+Scheduler = ApiScheduler(ApiRequestsPerMinute, ApiBurst)
+
+
+# Least recently used cache for ScoreSaber responses, entries expire after their TTL
+# Also keeps track of requests in flight, so identical requests at the same time share one API call
+class ApiCache:
+    def __init__(self, MaxSize):
+        self.MaxSize = MaxSize
+        # url: (expiry time, response text)
+        self.Entries = OrderedDict()
+        # url: future of the response text
+        self.InFlight = {}
+
+    # Gets a cached response, or None if it's missing or expired
+    def Get(self, url):
+        entry = self.Entries.get(url)
+        if entry is None:
+            return None
+        if entry[0] < time.monotonic():
+            del self.Entries[url]
+            return None
+        self.Entries.move_to_end(url)
+        return entry[1]
+
+    # Gets the time a cached response was fetched, from the ttl it was stored with, None if it isn't cached
+    def FetchedAt(self, url, ttl):
+        entry = self.Entries.get(url)
+        if entry is None:
+            return None
+        return time.time() - (time.monotonic() - (entry[0] - ttl))
+
+    # Stores a response, throwing out the least recently used ones when full
+    def Set(self, url, text, ttl):
+        self.Entries[url] = (time.monotonic() + ttl, text)
+        self.Entries.move_to_end(url)
+        while len(self.Entries) > self.MaxSize:
+            self.Entries.popitem(last=False)
+
+Cache = ApiCache(CacheSize)
+
+
+# A player's stats, only the parts of ScoreSaber's player data the bot actually uses
+# Snapshots never change once made, registrations notified about the same stats share the same snapshot
+class PlayerSnapshot:
+    __slots__ = ("id", "name", "country", "rank", "countryRank", "pp", "inactive", "banned", "avatar", "__weakref__")
+
+    def __init__(self, id, name, country, rank, countryRank, pp, inactive, banned, avatar):
+        self.id = id
+        self.name = name
+        self.country = country
+        self.rank = rank
+        self.countryRank = countryRank
+        self.pp = pp
+        self.inactive = inactive
+        self.banned = banned
+        self.avatar = avatar
+
+    def Values(self):
+        return (self.id, self.name, self.country, self.rank, self.countryRank, self.pp, self.inactive, self.banned, self.avatar)
+
+# Every snapshot in use, by its values, so identical snapshots only exist once
+Snapshots = weakref.WeakValueDictionary()
+# The most recent snapshot of every player, by playerId
+LatestPlayers = {}
+
+# Gets the snapshot with these values, making it if it doesn't exist yet
+def InternPlayer(*values):
+    snapshot = Snapshots.get(values)
+    if snapshot is None:
+        snapshot = Snapshots[values] = PlayerSnapshot(*values)
+    return snapshot
+
+# Turns player data from ScoreSaber (or the old SSData.json) into a snapshot, and remembers it as the player's most recent one
+# This is the only place ScoreSaber's datatype juggling is dealt with, everything after it can trust the types
+def ParsePlayer(data):
+    avatar = data.get("avatar") or ""
+    if avatar.startswith("/"):
+        avatar = ApiBaseURL + avatar
+    snapshot = InternPlayer(str(data["playerId"]), str(data["playerName"]), str(data.get("country") or ""), int(data["rank"]), int(data.get("countryRank") or 0), float(data["pp"]), int(data.get("inactive") or 0), int(data.get("banned") or 0), avatar)
+    LatestPlayers[snapshot.id] = snapshot
+    return snapshot
+
+
+# Registrations stored in SQLite, so changing one registration doesn't mean rewriting all of them
+# Every query runs on one worker thread, keeping disk access off the event loop
+# Players are stored once in their own table, registrations only keep the stats they were last notified about
+class RegistrationStore:
+    Columns = ["channelId", "discordUserId", "playerId", "ping", "globalRankThreshold", "countryRankThreshold", "ppThreshold", "rank", "countryRank", "pp", "inactive", "banned"]
+    PlayerColumns = ["playerId", "name", "country", "rank", "countryRank", "pp", "inactive", "banned", "avatar"]
+
+    def __init__(self, path):
+        self.Executor = ThreadPoolExecutor(max_workers=1)
+        # Only ever used from the executor thread (and here, before the bot starts)
+        # Poller workers use the same database, so wait for their writes instead of failing right away
+        self.Connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.Connection.execute("PRAGMA journal_mode=WAL")
+        self.Connection.execute("PRAGMA synchronous=NORMAL")
+        with self.Connection:
+            self.Connection.execute("CREATE TABLE IF NOT EXISTS players (playerId TEXT PRIMARY KEY, name TEXT NOT NULL, country TEXT NOT NULL, rank INTEGER NOT NULL, countryRank INTEGER NOT NULL, pp REAL NOT NULL, inactive INTEGER NOT NULL, banned INTEGER NOT NULL, avatar TEXT NOT NULL)")
+            self.Connection.execute("CREATE TABLE IF NOT EXISTS registrations (channelId INTEGER NOT NULL, discordUserId INTEGER NOT NULL, playerId TEXT NOT NULL, ping INTEGER NOT NULL, globalRankThreshold INTEGER NOT NULL, countryRankThreshold INTEGER NOT NULL, ppThreshold REAL NOT NULL, rank INTEGER NOT NULL, countryRank INTEGER NOT NULL, pp REAL NOT NULL, inactive INTEGER NOT NULL, banned INTEGER NOT NULL, PRIMARY KEY (channelId, discordUserId, playerId))")
+            self.Connection.execute("CREATE INDEX IF NOT EXISTS registrations_player ON registrations (playerId)")
+            # Stat update messages that haven't been sent yet
+            # Written by whichever process polled the player, and sent by the bot
+            self.Connection.execute("CREATE TABLE IF NOT EXISTS notifications (id INTEGER PRIMARY KEY AUTOINCREMENT, channelId INTEGER NOT NULL, ping TEXT NOT NULL, text TEXT NOT NULL, embed TEXT NOT NULL, discordUserId INTEGER NOT NULL, playerId TEXT NOT NULL)")
+            # Players still to be polled in the current window of every worker, so an interrupted window can be picked up where it stopped
+            self.Connection.execute("CREATE TABLE IF NOT EXISTS poll_cycle (worker TEXT NOT NULL, position INTEGER NOT NULL, playerId TEXT NOT NULL, PRIMARY KEY (worker, playerId))")
+            # Where every player's stats history is in the history file
+            self.Connection.execute("CREATE TABLE IF NOT EXISTS history_slots (playerId TEXT PRIMARY KEY, slot INTEGER NOT NULL UNIQUE)")
+            # Player names (casefolded) seen in ScoreSaber responses, so names can be looked up without asking ScoreSaber
+            self.Connection.execute("CREATE TABLE IF NOT EXISTS player_names (name TEXT PRIMARY KEY, playerId TEXT NOT NULL, seen REAL NOT NULL)")
+            # Last time every running poller worker was heard from
+            self.Connection.execute("CREATE TABLE IF NOT EXISTS poll_workers (name TEXT PRIMARY KEY, heartbeat REAL NOT NULL)")
+        self.MigrateJSON("SSData.json")
+        self.LoadPlayers()
+
+    # Loads the most recent stats of every player
+    def LoadPlayers(self):
+        for row in self.Connection.execute(f"SELECT {', '.join(self.PlayerColumns)} FROM players"):
+            LatestPlayers[row[0]] = InternPlayer(*row)
+
+    # One time import of the old SSData.json, which gets renamed afterwards so it's never imported twice
+    def MigrateJSON(self, path):
+        if not os.path.exists(path):
+            return
+        with open(path, "r") as f:
+            FullData = json.loads(f.read())
+        with self.Connection:
+            self.WriteRegistrations([dict(Player, playerInfo=ParsePlayer(Player["playerInfo"])) for Player in FullData])
+        os.replace(path, path + ".migrated")
+        print(f"Migrated {len(FullData)} registrations from {path}")
+
+    # Converts a registration to a database row
+    def ToRow(self, Player):
+        snapshot = Player["playerInfo"]
+        return (int(Player["channelId"]), int(Player["discordUserId"]), snapshot.id, int(bool(Player["ping"])), int(Player["globalRankThreshold"]), int(Player["countryRankThreshold"]), float(Player["ppThreshold"]), snapshot.rank, snapshot.countryRank, snapshot.pp, snapshot.inactive, snapshot.banned)
+
+    # Converts a database row back to a registration, with the player's most recent name, country and avatar
+    def FromRow(self, row):
+        latest = LatestPlayers.get(row[2])
+        name, country, avatar = (latest.name, latest.country, latest.avatar) if latest is not None else ("Unknown", "", "")
+        snapshot = InternPlayer(row[2], name, country, row[7], row[8], row[9], row[10], row[11], avatar)
+        return {"playerInfo": snapshot, "channelId": row[0], "discordUserId": row[1], "ping": bool(row[3]), "globalRankThreshold": row[4], "countryRankThreshold": row[5], "ppThreshold": row[6]}
+
+    # Writes registrations and the most recent stats of their players, inside a transaction on the database thread
+    def WriteRegistrations(self, Players):
+        self.Connection.executemany(f"INSERT OR REPLACE INTO registrations VALUES ({', '.join('?' * len(self.Columns))})", [self.ToRow(Player) for Player in Players])
+        self.WritePlayers({LatestPlayers.get(Player["playerInfo"].id, Player["playerInfo"]) for Player in Players})
+
+    def WritePlayers(self, snapshots):
+        self.Connection.executemany(f"INSERT OR REPLACE INTO players VALUES ({', '.join('?' * len(self.PlayerColumns))})", [snapshot.Values() for snapshot in snapshots])
+
+    # Runs a query function on the database thread
+    async def Run(self, func, *args):
+        return await asyncio.get_event_loop().run_in_executor(self.Executor, func, *args)
+
+    def Query(self, query, args=()):
+        return [self.FromRow(row) for row in self.Connection.execute(query, args)]
+
+    def Write(self, query, rows):
+        with self.Connection:
+            self.Connection.executemany(query, rows)
+
+    # Gets every registration, only used when loading the registry at startup
+    def All(self):
+        return self.Query(f"SELECT {', '.join(self.Columns)} FROM registrations")
+
+    # Adds registrations, or replaces them if they already exist
+    async def Upsert(self, Players):
+        def Write():
+            with self.Connection:
+                self.WriteRegistrations(Players)
+        await self.Run(Write)
+
+    # Removes a registration
+    async def Delete(self, channelId, discordUserId, playerId):
+        await self.Run(self.Write, "DELETE FROM registrations WHERE channelId = ? AND discordUserId = ? AND playerId = ?", [(channelId, discordUserId, str(playerId))])
+
+    # Gets every registration and the most recent stats of their players again, for poller workers
+    # The bot adds and removes registrations, workers only find out by reading them
+    def Reload(self):
+        self.LoadPlayers()
+        return self.All()
+
+    # Gets the players this worker has left to poll in an interrupted window, in their original order
+    async def GetCycle(self):
+        return await self.Run(lambda: [row[0] for row in self.Connection.execute("SELECT playerId FROM poll_cycle WHERE worker = ? ORDER BY position", (WorkerName,))])
+
+    # Remembers the players that are going to be polled in this window
+    async def StartCycle(self, playerIds):
+        def Start():
+            with self.Connection:
+                self.Connection.execute("DELETE FROM poll_cycle WHERE worker = ?", (WorkerName,))
+                self.Connection.executemany("INSERT INTO poll_cycle VALUES (?, ?, ?)", [(WorkerName, position, playerId) for position, playerId in enumerate(playerIds)])
+        await self.Run(Start)
+
+    # Saves the result of polling a single player in one transaction
+    # Their new stats, the changed registrations, the messages that still have to be sent, and that the player is done for this window
+    # Changed is a list of (registration, stats it had before), registrations are only changed if nobody else changed them in the meantime
+    # That keeps two workers that both think they own a player (right after a worker was added or removed) from sending the same message twice
+    # Returns the saved messages, as (message, id)
+    async def Checkpoint(self, playerId, snapshot, Changed, Messages):
+        def Write():
+            saved = []
+            with self.Connection:
+                if snapshot is not None:
+                    self.WritePlayers([snapshot])
+                for (Player, OldPlayer), message in zip(Changed, Messages):
+                    new = Player["playerInfo"]
+                    if self.Connection.execute("UPDATE registrations SET rank = ?, countryRank = ?, pp = ?, inactive = ?, banned = ? WHERE channelId = ? AND discordUserId = ? AND playerId = ? AND rank = ? AND countryRank = ? AND pp = ?", (new.rank, new.countryRank, new.pp, new.inactive, new.banned, int(Player["channelId"]), int(Player["discordUserId"]), new.id, OldPlayer.rank, OldPlayer.countryRank, OldPlayer.pp)).rowcount == 0:
+                        continue
+                    channelId, ping, text, embed = message
+                    saved.append((message, self.Connection.execute("INSERT INTO notifications (channelId, ping, text, embed, discordUserId, playerId) VALUES (?, ?, ?, ?, ?, ?)", (channelId, ping, text, json.dumps(embed.to_dict()), int(Player["discordUserId"]), new.id)).lastrowid))
+                self.Connection.execute("DELETE FROM poll_cycle WHERE worker = ? AND playerId = ?", (WorkerName, str(playerId)))
+            return saved
+        return await self.Run(Write)
+
+    # Marks players as done for this window without saving anything else, for players whose stats didn't change
+    async def FinishCycle(self, playerIds):
+        def Finish():
+            with self.Connection:
+                self.Connection.executemany("DELETE FROM poll_cycle WHERE worker = ? AND playerId = ?", [(WorkerName, str(playerId)) for playerId in playerIds])
+        await self.Run(Finish)
+
+    # Gets the messages that haven't been sent yet, newer than the given id, as (id, channelId, ping, text, embed, registration)
+    # registration is the registration the message is about as it is now, None if it's gone
+    async def GetNotifications(self, after=0):
+        def Read():
+            notifications = []
+            for row in self.Connection.execute(f"SELECT n.id, n.channelId, n.ping, n.text, n.embed, {', '.join('p.' + column for column in self.PlayerColumns)}, {', '.join('r.' + column for column in self.Columns)} FROM notifications n LEFT JOIN players p ON p.playerId = n.playerId LEFT JOIN registrations r ON r.channelId = n.channelId AND r.discordUserId = n.discordUserId AND r.playerId = n.playerId WHERE n.id > ? ORDER BY n.id", (after,)):
+                registration = None
+                if row[5 + len(self.PlayerColumns)] is not None:
+                    LatestPlayers[row[5]] = InternPlayer(*row[5:5 + len(self.PlayerColumns)])
+                    registration = self.FromRow(row[5 + len(self.PlayerColumns):])
+                notifications.append((row[0], row[1], row[2], row[3], discord.Embed.from_dict(json.loads(row[4])), registration))
+            return notifications
+        return await self.Run(Read)
+
+    # Gets the history slot of every player that has one
+    def HistorySlots(self):
+        return dict(self.Connection.execute("SELECT playerId, slot FROM history_slots"))
+
+    # Gets the history slot of a player, None if they don't have one
+    # With create, players without one get the lowest free slot, so slots freed by players nobody tracks anymore are used again
+    # claim readies the history file for the slot, it runs while the database is locked so two processes never resize the file at the same time
+    def HistorySlot(self, playerId, create=False, claim=None):
+        row = self.Connection.execute("SELECT slot FROM history_slots WHERE playerId = ?", (playerId,)).fetchone()
+        if row is not None or not create:
+            return None if row is None else row[0]
+        with self.Connection:
+            self.Connection.execute("INSERT OR IGNORE INTO history_slots SELECT ?, CASE WHEN NOT EXISTS (SELECT 1 FROM history_slots WHERE slot = 0) THEN 0 ELSE (SELECT MIN(slot) + 1 FROM history_slots WHERE slot + 1 NOT IN (SELECT slot FROM history_slots)) END", (playerId,))
+            slot = self.Connection.execute("SELECT slot FROM history_slots WHERE playerId = ?", (playerId,)).fetchone()[0]
+            claim(slot)
+        return slot
+
+    # Frees the history slots of players nobody is registered to anymore, returns their playerIds
+    # release runs for every freed slot while the database is locked
+    def FreeHistorySlots(self, release):
+        query = "SELECT playerId, slot FROM history_slots WHERE playerId NOT IN (SELECT playerId FROM registrations)"
+        # Nearly always nothing to free, which doesn't need to lock the database
+        if self.Connection.execute(query).fetchone() is None:
+            return []
+        with self.Connection:
+            # Locked right away, so two processes never free the same slots
+            self.Connection.execute("BEGIN IMMEDIATE")
+            rows = self.Connection.execute(query).fetchall()
+            self.Connection.executemany("DELETE FROM history_slots WHERE playerId = ?", [(playerId,) for playerId, slot in rows])
+            for playerId, slot in rows:
+                release(slot)
+        return [playerId for playerId, slot in rows]
+
+    # Forgets every history slot, when the history file had to be started over
+    def ClearHistorySlots(self):
+        with self.Connection:
+            self.Connection.execute("DELETE FROM history_slots")
+
+    # Gets every remembered player name as {name: (playerId, last seen)}
+    def PlayerNames(self):
+        return {row[0]: (row[1], row[2]) for row in self.Connection.execute("SELECT name, playerId, seen FROM player_names")}
+
+    # Remembers player names as (name, playerId, seen), and forgets names that expired
+    def WritePlayerNames(self, rows, expired):
+        with self.Connection:
+            self.Connection.executemany("INSERT OR REPLACE INTO player_names VALUES (?, ?, ?)", rows)
+            self.Connection.execute("DELETE FROM player_names WHERE seen < ?", (expired,))
+
+    # Gets the playerIds of names that are exactly the given name, or with prefix start with it, up to limit, exact matches first
+    def FindPlayerNames(self, name, expired, limit, prefix=False):
+        exact = self.Connection.execute("SELECT playerId FROM player_names WHERE name = ? AND seen >= ?", (name, expired)).fetchone()
+        if exact is not None or not prefix:
+            return [] if exact is None else [exact[0]]
+        # Names starting with the given name sort right after it, so the primary key index finds them without a table scan
+        return [row[0] for row in self.Connection.execute("SELECT DISTINCT playerId FROM player_names WHERE name > ? AND name < ? AND seen >= ? ORDER BY name LIMIT ?", (name, name + "\U0010ffff", expired, limit))]
+
+    # Marks a poller worker as running, and gets the names of every worker that is
+    # The bot isn't a worker when it doesn't poll itself, and only reads them
+    async def Heartbeat(self, name):
+        def Beat():
+            with self.Connection:
+                now = time.time()
+                if name is not None:
+                    self.Connection.execute("INSERT OR REPLACE INTO poll_workers VALUES (?, ?)", (name, now))
+                self.Connection.execute("DELETE FROM poll_workers WHERE heartbeat < ?", (now - WorkerTimeout,))
+                return [row[0] for row in self.Connection.execute("SELECT name FROM poll_workers ORDER BY name")]
+        return await self.Run(Beat)
+
+    # Gets the names of every running poller worker
+    async def GetWorkers(self):
+        return await self.Run(lambda: [row[0] for row in self.Connection.execute("SELECT name FROM poll_workers WHERE heartbeat >= ? ORDER BY name", (time.time() - WorkerTimeout,))])
+
+    # Removes messages once they've been sent
+    async def DeleteNotifications(self, notificationIds):
+        await self.Run(self.Write, "DELETE FROM notifications WHERE id = ?", [(notificationId,) for notificationId in notificationIds])
+
+Store = RegistrationStore(DatabasePath)
+
+
+# Every registration kept in memory, loaded once at startup and indexed every way commands look them up
+# Changes are written through to the store, the store is never read from again after loading
+# Poll cycles work on a snapshot, changes made during one apply right away and are logged for the poller to catch up on when it ends
+class RegistrationRegistry:
+    def __init__(self, store):
+        self.Store = store
+        # (channelId, discordUserId, playerId): registration
+        self.ByKey = {}
+        # (channelId, discordUserId): {playerId: registration}
+        self.ByChannelUser = {}
+        # playerId: {(channelId, discordUserId, playerId): registration}
+        self.ByPlayer = {}
+        # [(key, registration, or None if it was removed)] while a poll cycle is running, None otherwise
+        self.Log = None
+        for Player in store.All():
+            self.Index(Player)
+
+    # Gets the lookup key of a registration
+    def Key(self, Player):
+        return (int(Player["channelId"]), int(Player["discordUserId"]), Player["playerInfo"].id)
+
+    def Index(self, Player):
+        key = self.Key(Player)
+        self.ByKey[key] = Player
+        self.ByChannelUser.setdefault(key[:2], {})[key[2]] = Player
+        self.ByPlayer.setdefault(key[2], {})[key] = Player
+
+    def Unindex(self, key):
+        Player = self.ByKey.pop(key)
+        del self.ByChannelUser[key[:2]][key[2]]
+        if not self.ByChannelUser[key[:2]]:
+            del self.ByChannelUser[key[:2]]
+        del self.ByPlayer[key[2]][key]
+        if not self.ByPlayer[key[2]]:
+            del self.ByPlayer[key[2]]
+        return Player
+
+    # Gets a single registration, or None if it doesn't exist
+    def Get(self, channelId, discordUserId, playerId):
+        return self.ByKey.get((channelId, discordUserId, str(playerId)))
+
+    # Gets every registration of a user in a channel
+    def GetByChannelUser(self, channelId, discordUserId):
+        return list(self.ByChannelUser.get((channelId, discordUserId), {}).values())
+
+    # Gets every registration of a player
+    def GetByPlayer(self, playerId):
+        return list(self.ByPlayer.get(str(playerId), {}).values())
+
+    # Adds a registration, replacing it if it already exists
+    async def Add(self, Player):
+        self.Index(Player)
+        if self.Log is not None:
+            self.Log.append((self.Key(Player), Player))
+        await self.Store.Upsert([Player])
+
+    # Removes a registration, returns the removed registration or None if it didn't exist
+    async def Remove(self, channelId, discordUserId, playerId):
+        key = (channelId, discordUserId, str(playerId))
+        if key not in self.ByKey:
+            return None
+        Player = self.Unindex(key)
+        if self.Log is not None:
+            self.Log.append((key, None))
+        await self.Store.Delete(*key)
+        return Player
+
+    # Saves the result of polling a player, only for registrations that are still registered
+    async def Checkpoint(self, playerId, snapshot, Changed, Messages):
+        Kept = [(change, message) for change, message in zip(Changed, Messages) if self.ByKey.get(self.Key(change[0])) is change[0]]
+        return await self.Store.Checkpoint(playerId, snapshot, [change for change, message in Kept], [message for change, message in Kept])
+
+    # Starts a poll cycle, returns the registrations it polls as {playerId: (registration, ...)}
+    # The snapshot never changes, no matter how long the cycle takes or what commands do in the meantime
+    def StartCycle(self):
+        self.Log = []
+        return {playerId: tuple(registrations.values()) for playerId, registrations in self.ByPlayer.items()}
+
+    # Ends the poll cycle, returns the changes made during it
+    def EndCycle(self):
+        Log, self.Log = self.Log, None
+        return Log or []
+
+    # Takes over the stats a registration was last notified about from the store, after another process polled its player
+    def Apply(self, Player):
+        registration = self.ByKey.get(self.Key(Player))
+        if registration is not None:
+            registration["playerInfo"] = Player["playerInfo"]
+
+    # Loads every registration from the store again, only for poller workers, which never add or remove registrations themselves
+    async def Reload(self):
+        Players = await self.Store.Run(self.Store.Reload)
+        self.ByKey = {}
+        self.ByChannelUser = {}
+        self.ByPlayer = {}
+        for Player in Players:
+            self.Index(Player)
+
+Registry = RegistrationRegistry(Store)
+
+
+# Decides when each player gets polled next
+# Players that keep changing are polled often, players that don't (or can't, when inactive or banned) less and less
+class PollScheduler:
+    def __init__(self):
+        # playerId: [next poll time, interval, (rank, countryRank, pp) last seen]
+        self.Players = {}
+
+    # Gets the players due for a poll before the given time, the ones that have waited longest first
+    # Players that have never been polled are due right away
+    def Due(self, playerIds, until):
+        due = []
+        for playerId in playerIds:
+            state = self.Players.get(playerId)
+            NextPoll = 0 if state is None else state[0]
+            if NextPoll <= until:
+                due.append((NextPoll, playerId))
+        due.sort()
+        return [playerId for NextPoll, playerId in due]
+
+    # Stops tracking players that are no longer registered
+    def Prune(self, playerIds):
+        for playerId in list(self.Players.keys()):
+            if playerId not in playerIds:
+                del self.Players[playerId]
+
+    # Schedules the next poll of a player based on what changed, their status and what their registrations care about
+    def Update(self, playerId, NewPlayer, Registrations):
+        state = self.Players.get(playerId)
+        seen = (NewPlayer.rank, NewPlayer.countryRank, NewPlayer.pp)
+        if state is None:
+            interval = PollIntervalMin
+        elif state[2] != seen:
+            # Something changed, they're probably playing right now
+            interval = max(PollIntervalMin, state[1] / 2)
+        else:
+            interval = min(PollIntervalMax, state[1] * 1.5)
+        # Registrations only interested in large changes can wait longer
+        if Registrations and not any(self.IsTight(Player) for Player in Registrations):
+            effective = min(PollIntervalMax, interval * 2)
+        else:
+            effective = interval
+        if NewPlayer.inactive == 1 or NewPlayer.banned == 1:
+            effective = PollIntervalInactive
+        self.Players[playerId] = [time.time() + effective, interval, seen]
+
+    # Gets the (rank, countryRank, pp) a player had when last polled, or None if they haven't been polled yet
+    def LastSeen(self, playerId):
+        state = self.Players.get(playerId)
+        return None if state is None else state[2]
+
+    # Checks if a registration wants to hear about small changes
+    def IsTight(self, Player):
+        return int(Player["globalRankThreshold"]) <= 10 or int(Player["countryRankThreshold"]) <= 5 or float(Player["ppThreshold"]) <= 1
+
+Poller = PollScheduler()
+
+
+# Remembers the last response of every polled player, so players whose stats didn't change cost next to nothing to poll
+# Unchanged players skip decoding (same response) or the response entirely (304 to an ETag), and then skip every write
+class ChangeDetector:
+    def __init__(self):
+        # playerId: (stats, ETag, digest of the response text)
+        self.Players = {}
+
+    def Digest(self, text):
+        return hashlib.blake2b(text.encode(), digest_size=16).digest()
+
+    # Gets (stats, ETag, digest) of a player's last response, or None if they haven't been polled yet
+    def Get(self, playerId):
+        return self.Players.get(playerId)
+
+    # Remembers a player's latest response, returns whether their stats changed since the one before it
+    # Stats from a leaderboard page have no response of their own, the last one is kept if the stats are still the same
+    def Remember(self, playerId, snapshot, etag=None, digest=None):
+        last = self.Players.get(playerId)
+        # Snapshots with the same values are the same object, so this compares every stat at once
+        changed = last is None or last[0] is not snapshot
+        if digest is None and not changed:
+            return False
+        self.Players[playerId] = (snapshot, etag, digest)
+        return changed
+
+    # Forgets players that are no longer registered
+    def Prune(self, playerIds):
+        for playerId in list(self.Players.keys()):
+            if playerId not in playerIds:
+                del self.Players[playerId]
+
+Changes = ChangeDetector()
+
+
+# Keeps track of how well refreshing players from leaderboard pages works out, so pages are only requested when they're worth it
+# A page is worth requesting if it likely spares at least one request more than the one it costs
+# Players polled on their own count too, by whether their page would have spared them, so skipped pages still get measured
+class PageRefresher:
+    # What a page that hasn't been requested yet is expected to spare, per due player on it
+    Prior = 0.25
+    # Seconds after which half of what a page did is forgotten, so pages that didn't help get another chance later
+    HalfLife = 3600
+
+    def __init__(self):
+        # page: (fraction of due players on it the page spared a request for, time it was last requested)
+        self.Rates = {}
+        # playerId: time of their last own request
+        self.LastBasic = {}
+
+    # Gets the fraction of due players a page is expected to spare a request for
+    def Rate(self, page, now=None):
+        now = time.time() if now is None else now
+        rate, updated = self.Rates.get(page, (self.Prior, now))
+        return self.Prior + (rate - self.Prior) * 0.5 ** ((now - updated) / self.HalfLife)
+
+    # Checks if a page is worth requesting for this many due players
+    def IsWorth(self, page, due):
+        return due * self.Rate(page) >= 2
+
+    # Remembers how many of the due players a page spared (or would have spared) a request for
+    # The more players it's about, the more it counts
+    def Record(self, page, due, spared):
+        now = time.time()
+        rate = self.Rate(page, now)
+        self.Rates[page] = (rate + (spared / due - rate) * due / (due + 5), now)
+
+    # Remembers that a player got their own request
+    def Polled(self, playerId):
+        self.LastBasic[playerId] = time.time()
+
+    # Checks if a player has gone too long without their own request, the first time a player is seen counts as one
+    def NeedsBasic(self, playerId):
+        return time.time() - self.LastBasic.setdefault(playerId, time.time()) >= PollIntervalBasic
+
+    # Forgets players that are no longer registered
+    def Prune(self, playerIds):
+        for playerId in list(self.LastBasic.keys()):
+            if playerId not in playerIds:
+                del self.LastBasic[playerId]
+
+PageRefresh = PageRefresher()
+
+
+# Stats history of every player, in one memory mapped file of fixed size ring buffers
+# Every player gets a slot of Samples samples, once it's full the oldest sample gets overwritten, so a player never takes up more than one slot
+# A sample is (timestamp, rank, countryRank, pp) in 16 bytes, where slots are is kept in the database
+# Slots of players nobody tracks anymore are freed and handed to new players, so the file only grows with the amount of tracked players
+# Poller workers write the samples of their players, the bot reads them straight from the same file
+class PlayerHistory:
+    # Magic, samples per slot
+    FileHeader = struct.Struct("<8sQ")
+    # Samples ever written to the slot, owner of the slot
+    # The owner is a hash of the playerId, so processes notice when a slot they remember was given to someone else
+    # 1 is a free slot
+    SlotHeader = struct.Struct("<QQ")
+    Sample = struct.Struct("<IIIf")
+    # The file grows this many slots at a time
+    GrowSlots = 256
+
+    def __init__(self, path, store, samples, interval):
+        self.Store = store
+        self.Samples = samples
+        self.Interval = interval
+        self.SlotSize = self.SlotHeader.size + samples * self.Sample.size
+        # A file made with a different amount of samples per slot can't be read, start over
+        if os.path.exists(path) and os.path.getsize(path) >= self.FileHeader.size:
+            with open(path, "rb") as f:
+                magic, FileSamples = self.FileHeader.unpack(f.read(self.FileHeader.size))
+            if magic != b"SSHIST01" or FileSamples != samples:
+                os.replace(path, path + ".old")
+                store.ClearHistorySlots()
+        self.File = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        if os.fstat(self.File).st_size < self.FileHeader.size:
+            os.ftruncate(self.File, self.FileHeader.size + self.GrowSlots * self.SlotSize)
+            os.pwrite(self.File, self.FileHeader.pack(b"SSHIST01", samples), 0)
+        self.Map = mmap.mmap(self.File, 0)
+        # Players that stopped being tracked while the bot was down
+        store.FreeHistorySlots(self.Release)
+        # playerId: slot
+        self.Slots = store.HistorySlots()
+
+    # Gets the owner of a slot for a player
+    def Owner(self, playerId):
+        return max(2, int.from_bytes(hashlib.blake2b(str(playerId).encode(), digest_size=8).digest(), "little"))
+
+    # Readies a newly handed out slot for a player, only called while the database is locked
+    def Claim(self, slot, playerId):
+        self.Grow(slot)
+        os.pwrite(self.File, self.SlotHeader.pack(0, self.Owner(playerId)), self.FileHeader.size + slot * self.SlotSize)
+
+    # Marks a slot as free, only called while the database is locked
+    def Release(self, slot):
+        os.pwrite(self.File, self.SlotHeader.pack(0, 1), self.FileHeader.size + slot * self.SlotSize)
+
+    # Checks if a slot still belongs to a player
+    def Owns(self, slot, playerId):
+        return self.SlotHeader.unpack_from(self.Map, self.Offset(slot))[1] == self.Owner(playerId)
+
+    # Makes the file big enough for a slot, only called while the database is locked
+    def Grow(self, slot):
+        size = self.FileHeader.size + (slot // self.GrowSlots + 1) * self.GrowSlots * self.SlotSize
+        if os.fstat(self.File).st_size < size:
+            os.ftruncate(self.File, size)
+
+    # Gets the offset of a slot, remapping the file if another process made it bigger
+    def Offset(self, slot):
+        offset = self.FileHeader.size + slot * self.SlotSize
+        if offset + self.SlotSize > len(self.Map):
+            self.Map.close()
+            self.Map = mmap.mmap(self.File, 0)
+        return offset
+
+    # Gets the slot of a player, None if they don't have one and create isn't set
+    async def Slot(self, playerId, create=False):
+        slot = self.Slots.get(playerId)
+        # Freed (and maybe handed to someone else) by another process since
+        if slot is not None and not self.Owns(slot, playerId):
+            del self.Slots[playerId]
+            slot = None
+        if slot is None:
+            slot = await self.Store.Run(self.Store.HistorySlot, playerId, create, lambda slot: self.Claim(slot, playerId))
+            if slot is not None:
+                self.Slots[playerId] = slot
+        return slot
+
+    # Frees the slots of players nobody is registered to anymore
+    async def Free(self):
+        for playerId in await self.Store.Run(self.Store.FreeHistorySlots, self.Release):
+            self.Slots.pop(playerId, None)
+
+    # Adds a sample of a player's stats
+    async def Append(self, snapshot, now=None):
+        now = int(time.time() if now is None else now)
+        offset = self.Offset(await self.Slot(snapshot.id, create=True))
+        count = self.SlotHeader.unpack_from(self.Map, offset)[0]
+        # Polls in the same period replace that period's sample, instead of filling the slot with duplicates
+        if count > 0:
+            last = self.Sample.unpack_from(self.Map, offset + self.SlotHeader.size + (count - 1) % self.Samples * self.Sample.size)
+            if last[0] // self.Interval == now // self.Interval:
+                # Nothing to write if the stats are the same too
+                if last[1:] == self.Sample.unpack(self.Sample.pack(0, snapshot.rank, snapshot.countryRank, snapshot.pp))[1:]:
+                    return
+                count -= 1
+        self.Sample.pack_into(self.Map, offset + self.SlotHeader.size + count % self.Samples * self.Sample.size, now, snapshot.rank, snapshot.countryRank, snapshot.pp)
+        self.SlotHeader.pack_into(self.Map, offset, count + 1, self.Owner(snapshot.id))
+
+    # Gets a player's samples since a time, oldest first
+    async def Get(self, playerId, since=0):
+        slot = await self.Slot(playerId)
+        if slot is None:
+            return []
+        offset = self.Offset(slot)
+        count = self.SlotHeader.unpack_from(self.Map, offset)[0]
+        samples = []
+        for n in range(max(0, count - self.Samples), count):
+            sample = self.Sample.unpack_from(self.Map, offset + self.SlotHeader.size + n % self.Samples * self.Sample.size)
+            if sample[0] >= since:
+                samples.append(sample)
+        return samples
+
+History = PlayerHistory(HistoryPath, Store, HistorySamples, HistoryInterval)
+
+
+# The top of the global leaderboard, kept in memory and refreshed a page at a time in the background
+# Answers who is near a rank, who is #1 and who is a random top player without asking ScoreSaber
+class LeaderboardIndex:
+    def __init__(self, pages):
+        self.Pages = pages
+        # Ordered by rank, rank n is at n - 1, None until its page has been loaded
+        self.Entries = [None] * (pages * 50)
+        # Time every page was last loaded, 0 if it hasn't been yet
+        self.Updated = [0] * pages
+
+    # Stores a page of players from ScoreSaber, fetched at the given time, pages past the top ones are ignored
+    # A page fetched before the one already stored (from the response cache) doesn't replace it
+    def Update(self, page, players, fetched):
+        if page > self.Pages or fetched < self.Updated[page - 1]:
+            return
+        # A page with fewer players than last time doesn't keep the ones it no longer lists
+        self.Entries[(page - 1) * 50:page * 50] = [None] * 50
+        for player in players:
+            entry = ParseLeaderboardEntry(player)
+            if 1 <= entry["rank"] <= len(self.Entries):
+                self.Entries[entry["rank"] - 1] = entry
+        self.Updated[page - 1] = fetched
+
+    def IsLoaded(self, page):
+        return page <= self.Pages and self.Updated[page - 1] > 0
+
+    # Gets the players on a loaded page
+    def GetPage(self, page):
+        return [entry for entry in self.Entries[(page - 1) * 50:page * 50] if entry is not None]
+
+    # Gets the page that was refreshed longest ago
+    def Stalest(self):
+        return min(range(self.Pages), key=lambda n: self.Updated[n]) + 1
+
+    # Gets the players within spread of a rank, as (players, time the oldest page used was loaded)
+    # Pages that aren't loaded (or past the top ones) are requested
+    async def Around(self, rank, spread):
+        players = []
+        updated = time.time()
+        for page in sorted({GetScoreBoardNum(near) for near in range(max(1, rank - spread), rank + spread + 1)}):
+            if self.IsLoaded(page):
+                entries = self.GetPage(page)
+                updated = min(updated, self.Updated[page - 1])
+            else:
+                listed, fetched = await FetchLeaderboardPage(page)
+                entries = [ParseLeaderboardEntry(player) for player in listed]
+                updated = min(updated, fetched)
+            players.extend(entry for entry in entries if not CheckThreshold(entry["rank"], rank, spread))
+        return sorted(players, key=lambda entry: entry["rank"]), updated
+
+    # Gets the player at a rank, None if their page isn't loaded
+    def Get(self, rank):
+        return self.Entries[rank - 1] if 1 <= rank <= len(self.Entries) else None
+
+    # Gets a random player off the loaded pages, None if nothing has been loaded yet
+    def Random(self):
+        loaded = [page for page in range(1, self.Pages + 1) if self.IsLoaded(page)]
+        if not loaded:
+            return None
+        entries = self.GetPage(random.choice(loaded))
+        return random.choice(entries) if entries else None
+
+Leaderboard = LeaderboardIndex(LeaderboardPages)
+
+
+# Player names to ScoreSaber IDs, learnt from every response the bot gets anyway, and kept in the database
+# Names are matched casefolded, and a name that only one remembered name starts with matches too
+# Names not seen for NameExpiry seconds are forgotten, in case the player renamed and someone else took the name
+class NameIndex:
+    def __init__(self, store, expiry):
+        self.Store = store
+        self.Expiry = expiry
+        # name: (playerId, last seen), what the database has, so names that didn't change aren't written again
+        self.Known = store.PlayerNames()
+        # name: (playerId, seen) waiting to be written
+        self.Pending = {}
+        self.FlushTask = None
+        # Everyone registered has a name already
+        now = time.time()
+        for snapshot in LatestPlayers.values():
+            self.Remember(snapshot.name, snapshot.id, now)
+
+    # Normalizes a name for matching
+    def Key(self, name):
+        return str(name).strip().casefold()
+
+    # Remembers that a player has a name, written to the database a few seconds later together with other names
+    def Remember(self, name, playerId, now=None):
+        now = time.time() if now is None else now
+        key = self.Key(name)
+        known = self.Known.get(key)
+        # Names seen less than a day ago don't need their time updated
+        if not key or (known is not None and known[0] == str(playerId) and now - known[1] < 86400):
+            return
+        self.Known[key] = self.Pending[key] = (str(playerId), now)
+        if self.FlushTask is None:
+            try:
+                self.FlushTask = asyncio.get_running_loop().create_task(self.Flush())
+            except RuntimeError:
+                # Before the event loop exists (at startup), the first name remembered after it does will write these too
+                pass
+
+    # Writes the pending names
+    async def Flush(self):
+        await asyncio.sleep(5)
+        rows = [(key, playerId, seen) for key, (playerId, seen) in self.Pending.items()]
+        self.Pending = {}
+        self.FlushTask = None
+        expired = time.time() - self.Expiry
+        for key in [key for key, (playerId, seen) in self.Known.items() if seen < expired]:
+            del self.Known[key]
+        try:
+            await self.Store.Run(self.Store.WritePlayerNames, rows, expired)
+        except Exception as ex:
+            print(ex)
+
+    # Gets the playerId of a name, None if it isn't known
+    # prefix also finds a name starting with it, if only one does, which can be a different player than someone who has the exact name
+    # so it's only for commands that don't change anything
+    async def Resolve(self, name, prefix=False):
+        key = self.Key(name)
+        if not key:
+            return None
+        # Names that haven't been written yet aren't in the database
+        known = self.Known.get(key)
+        if known is not None and known[1] >= time.time() - self.Expiry:
+            return known[0]
+        matches = await self.Store.Run(self.Store.FindPlayerNames, key, time.time() - self.Expiry, 2, prefix)
+        return matches[0] if len(matches) == 1 else None
+
+Names = NameIndex(Store, NameExpiry)
+
+
+# Sends stat update messages shortly after they're queued
+# Every channel gets its own worker so messages to one channel stay in order, different channels are sent to in parallel
+# Updates queued for the same channel are sent together, up to 10 embeds per message with every ping on one line
+# Discord.py waits on Discord's per-route ratelimit buckets itself, so there's no need for sleeping between messages
+class DeliveryQueue:
+    # Discord's limits on a single message
+    MaxEmbeds = 10
+    MaxEmbedCharacters = 6000
+    MaxContent = 2000
+    # Times a message that failed to send is tried again, and the seconds before the first retry, doubling every retry
+    MaxRetries = 5
+    RetryDelay = 5
+
+    def __init__(self, concurrency, delay):
+        # channelId: deque of (ping, text, embed, notificationId)
+        self.Queues = {}
+        self.Delay = delay
+        # Ids of saved messages that are queued or being sent
+        self.Pending = set()
+        self.Concurrency = concurrency
+        self.Limit = None
+
+    # Queues a message, starting a worker for the channel if it doesn't have one
+    # notificationId is the id of the saved message, which gets removed once it's been sent
+    def Put(self, channelId, ping, text, embed, notificationId=None):
+        if notificationId is not None:
+            if notificationId in self.Pending:
+                return
+            self.Pending.add(notificationId)
+        if self.Limit is None:
+            self.Limit = asyncio.Semaphore(self.Concurrency)
+        queue = self.Queues.get(channelId)
+        if queue is None:
+            queue = self.Queues[channelId] = deque()
+            asyncio.get_event_loop().create_task(self.Worker(channelId, queue))
+        queue.append((ping, text, embed, notificationId))
+
+    # Takes as many queued updates as fit in one message
+    def TakeBatch(self, queue):
+        batch = [queue.popleft()]
+        characters = len(batch[0][0]) + len(batch[0][1])
+        embedCharacters = len(batch[0][2])
+        while queue and len(batch) < self.MaxEmbeds:
+            ping, text, embed, notificationId = queue[0]
+            # Pings and text lines of every update, plus the spaces and newlines between them
+            if embedCharacters + len(embed) > self.MaxEmbedCharacters or characters + len(text) + len(ping) + 2 > self.MaxContent:
+                break
+            batch.append(queue.popleft())
+            characters += len(text) + len(ping) + 2
+            embedCharacters += len(embed)
+        return batch
+
+    # Sends every update queued for a channel, then stops
+    # Saved messages are only removed once they're sent, or Discord refused them for good
+    async def Worker(self, channelId, queue):
+        failures = 0
+        while queue:
+            # Give updates that come in around the same time a moment to be sent together
+            if len(queue) < self.MaxEmbeds:
+                await asyncio.sleep(self.Delay)
+            batch = self.TakeBatch(queue)
+            # Ping everyone once, in front of the first line
+            pings = " ".join(dict.fromkeys(ping for ping, text, embed, notificationId in batch if ping))
+            content = (f"{pings} " if pings else "") + "\n".join(text for ping, text, embed, notificationId in batch)
+            # Whichever shard the channel is on, the client finds it
+            channel = client.get_channel(channelId)
+            done = True
+            if channel is None:
+                # Channels that were deleted, or that the bot was removed from
+                Metrics.Count("discord_send_errors_total")
+            else:
+                async with self.Limit:
+                    start = time.monotonic()
+                    try:
+                        await SendEmbeds(channel, content, [embed for ping, text, embed, notificationId in batch])
+                        Metrics.Count("discord_sends_total")
+                        Metrics.Count("discord_updates_sent_total", value=len(batch))
+                    except discord.HTTPException as ex:
+                        Metrics.Count("discord_send_errors_total")
+                        # Refused by Discord (missing access, unknown channel, bad message), sending it again won't help
+                        # Anything on Discord's end might work next time
+                        done = ex.status < 500
+                    except Exception:
+                        # Connection problems
+                        Metrics.Count("discord_send_errors_total")
+                        done = False
+                    Metrics.Observe("discord_send_seconds", time.monotonic() - start)
+            notificationIds = [notificationId for ping, text, embed, notificationId in batch if notificationId is not None]
+            if not done:
+                failures += 1
+                if failures <= self.MaxRetries:
+                    queue.extendleft(reversed(batch))
+                    await asyncio.sleep(self.RetryDelay * 2 ** (failures - 1))
+                    continue
+                # Still failing, saved messages stay saved and are sent after the next restart
+                failures = 0
+                self.Pending.difference_update(notificationIds)
+                continue
+            failures = 0
+            if notificationIds:
+                await Store.DeleteNotifications(notificationIds)
+                self.Pending.difference_update(notificationIds)
+        del self.Queues[channelId]
+
+Delivery = DeliveryQueue(DeliveryConcurrency, DeliveryBatchDelay)
 
 
 # Functions
@@ -52,22 +1235,139 @@ def GetScoreBoardNum(rank):
     # return math.ceil(rank / 50)
     return int(rank / 50) + (rank % 50 > 0)
 
+# Gets the shared HTTP session, keeping connections to ScoreSaber alive between requests
+def GetHttpSession():
+    global HttpSession
+    if HttpSession is None or HttpSession.closed:
+        headers = {"User-Agent": "ScoreSaber Stats Bot", "From": SourceURL}
+        connector = aiohttp.TCPConnector(limit=8, keepalive_timeout=60)
+        HttpSession = aiohttp.ClientSession(connector=connector, headers=headers, timeout=aiohttp.ClientTimeout(total=ApiTimeout))
+    return HttpSession
+
+# Closes the shared HTTP session
+async def CloseHttpSession():
+    global HttpSession
+    if HttpSession is not None and not HttpSession.closed:
+        await HttpSession.close()
+    HttpSession = None
+
+# Reads the Retry-After header ScoreSaber sends with a 429, in seconds
+def GetRetryAfter(r):
+    try:
+        return max(1.0, float(r.headers.get("Retry-After", 60)))
+    except ValueError:
+        return 60.0
+
+# Gets the name of the ScoreSaber endpoint a url is for, used to label metrics
+def GetEndpoint(url):
+    if url.endswith("/basic"):
+        return "basic"
+    if "/by-name/" in url:
+        return "by-name"
+    if "/api/players/" in url:
+        return "players"
+    return "other"
+
 # Does an API call and should (but doesn't) handle errors with ScoreSaber API
-def ApiCall(url):
-    headers = {"User-Agent": "ScoreSaber Stats Bot", "From": SourceURL}
-    r = requests.get(url, allow_redirects=True, headers=headers)
-    return r.text
+# Doesn't block the event loop while waiting on ScoreSaber, so commands and heartbeats keep going
+# Every call waits its turn in the scheduler, so the bot as a whole stays within the API budget
+async def ApiCall(url, priority=PriorityCommand):
+    return (await ApiRequest(url, priority))[1]
+
+# Does an API call, returning (status, response text, ETag)
+# With an ETag from an earlier response, ScoreSaber can answer 304 with no text if nothing changed since, if it supports that
+async def ApiRequest(url, priority=PriorityCommand, etag=None):
+    labels = (("endpoint", GetEndpoint(url)),)
+    headers = {} if etag is None else {"If-None-Match": etag}
+    # A command asking ScoreSaber keeps its cooldown
+    reservation = CommandUse.get()
+    if reservation is not None and priority == PriorityCommand:
+        reservation[2] = True
+    for attempt in range(ApiMaxRetries + 1):
+        await Scheduler.Acquire(priority)
+        Metrics.Mark("api_requests")
+        start = time.monotonic()
+        try:
+            async with GetHttpSession().get(url, allow_redirects=True, headers=headers) as r:
+                Metrics.Count("api_requests_total", labels + (("status", r.status),))
+                if r.status != 429 or attempt == ApiMaxRetries:
+                    text = "" if r.status == 304 else await r.text()
+                    Metrics.Observe("api_request_seconds", time.monotonic() - start, labels)
+                    return r.status, text, r.headers.get("ETag")
+                # Ratelimited, hold back every request (not just this one) for as long as ScoreSaber asks
+                Scheduler.Pause(GetRetryAfter(r))
+        except Exception:
+            Metrics.Count("api_errors_total", labels)
+            raise
+
+# Runs factory, unless it's already running for this key, in which case its result is shared instead
+# InFlight holds the futures of everything currently running
+async def SingleFlight(InFlight, key, factory):
+    shared = InFlight.get(key)
+    if shared is not None:
+        try:
+            return await asyncio.shield(shared)
+        except asyncio.CancelledError:
+            # Only carry on if it was whoever is running factory that got cancelled, not us
+            if not shared.cancelled():
+                raise
+        return await SingleFlight(InFlight, key, factory)
+    future = asyncio.get_event_loop().create_future()
+    InFlight[key] = future
+    try:
+        result = await factory()
+        future.set_result(result)
+        return result
+    except Exception as ex:
+        future.set_exception(ex)
+        # Mark the exception as retrieved, nobody else might be waiting on it
+        future.exception()
+        raise
+    finally:
+        del InFlight[key]
+        # Cancelled, everyone waiting on this would otherwise wait forever
+        if not future.done():
+            future.cancel()
+
+# Does an API call, reusing the response if it was requested less than ttl seconds ago
+# refresh skips the cached response, but still stores the new one for everyone else
+async def CachedApiCall(url, ttl, priority=PriorityCommand, refresh=False):
+    labels = (("endpoint", GetEndpoint(url)),)
+    if not refresh:
+        text = Cache.Get(url)
+        if text is not None:
+            Metrics.Count("cache_hits_total", labels)
+            return text
+    # Someone is already requesting this, wait for their response instead of requesting it again
+    if url in Cache.InFlight:
+        Metrics.Count("cache_shared_total", labels)
+    else:
+        Metrics.Count("cache_misses_total", labels)
+    return await SingleFlight(Cache.InFlight, url, lambda: FetchAndCache(url, ttl, priority))
+
+async def FetchAndCache(url, ttl, priority):
+    status, text, etag = await ApiRequest(url, priority)
+    # Don't hold on to errors, the player might exist next time
+    if status == 200:
+        Cache.Set(url, text, ttl)
+    return text
 
 # Gets a profile from a scoresaber name
-def GetSSProfileName(text):
-    url = f"https://new.scoresaber.com/api/players/by-name/{text}"
-    SearchData = json.loads(ApiCall(url))
+async def GetSSProfileName(text, priority=PriorityCommand):
+    url = f"{ApiBaseURL}/api/players/by-name/{text}"
+    SearchData = json.loads(await CachedApiCall(url, CacheTTL["by-name"], priority))
     if "error" in SearchData.keys():
         raise KeyError
+    for player in SearchData["players"]:
+        Names.Remember(player["playerName"], player["playerId"])
+    # Someone with exactly this name goes before anyone whose name just contains it
+    for player in SearchData["players"]:
+        if Names.Key(player["playerName"]) == Names.Key(text):
+            return player
     return SearchData["players"][0]
 
-# Gets a profile from ScoreSaber
-def GetSSProfileAll(ssplayer):
+# Gets the ScoreSaber ID of a player from a name, ID or URL
+async def GetSSPlayerID(ssplayer):
     player = {}
     # Set ssid to 0 for checking if it was set
     ssid = 0
@@ -85,31 +1385,63 @@ def GetSSProfileAll(ssplayer):
         try:
             ssid = int(ssplayer)
         except:
-            pass
-        # Not a link or a user id, check if a player of this name exists
-        player = GetSSProfileName(ssplayer)
+            # Not a link or a user id, names the bot has seen before don't need a request
+            # Only exact names, a known longer name starting with it could hide a player with exactly this name
+            playerId = await Names.Resolve(ssplayer)
+            if playerId is not None:
+                return playerId
+            # Check if a player of this name exists
+            player = await GetSSProfileName(ssplayer)
     # No ID was found and the player does not exist
     if ssid == 0 and player == {}:
         raise KeyError
     # No player was found but an ID was found
     if player == {} and ssid != 0:
         try:
-            player = GetStatsID(ssid)
+            player = await GetStatsID(ssid)
         except:
             raise KeyError
-    return player
+        return player.id
+    return str(player["playerId"])
+
+# Gets the ID of a player the bot tracks from a name, ID or URL, without asking ScoreSaber
+# Returns None if no tracked player matches
+def GetTrackedPlayerID(ssplayer):
+    if "scoresaber.com" in str(ssplayer):
+        for urlpart in ssplayer.split("/"):
+            try:
+                return str(int(urlpart.split("&")[0].split("#")[0]))
+            except:
+                pass
+        return None
+    try:
+        return str(int(ssplayer))
+    except:
+        pass
+    known = Names.Known.get(Names.Key(ssplayer))
+    return None if known is None else known[0]
 
 # Take a scoresaber id and check if the profile exists
-def CheckIfSSIDExists(ssid):
-    url = f"https://new.scoresaber.com/api/player/{ssid}/basic"
+async def CheckIfSSIDExists(ssid):
+    url = f"{ApiBaseURL}/api/player/{ssid}/basic"
     # Request the URL and load it in as a JSON dict
     try:
-        PlayerData = json.loads(ApiCall(url))
+        PlayerData = json.loads(await CachedApiCall(url, CacheTTL["basic"]))
     except:
         return False
     # If scoresaber throws an error, we return False, else we return True
     return "error" not in PlayerData
 
+# Sends a message with up to 10 embeds
+# discord.py 1.x only sends one embed per message, so messages with more are made through its HTTP client, which still waits on Discord's ratelimits
+async def SendEmbeds(channel, content, embeds):
+    if len(embeds) == 1:
+        await channel.send(content, embed=embeds[0])
+    elif "embeds" in inspect.signature(channel.send).parameters:
+        await channel.send(content, embeds=embeds)
+    else:
+        await client.http.request(Route("POST", "/channels/{channel_id}/messages", channel_id=channel.id), json={"content": content, "embeds": [embed.to_dict() for embed in embeds]})
+
 # Get Default Embed
 def GetEmbed(title, text):
     return discord.Embed(title=title, type="rich", description=text, color=discord.colour.Color.from_rgb(255, 222, 26)).set_footer(icon_url=ProfilePicture, text="ScoreSaber Stats")
@@ -119,28 +1451,69 @@ def GetEmbedWithSupportLink(title, text):
     return GetEmbed(title, text + f"\n[Support Server]({SupportServer})")
 
 # Gets a players stats assuming they exist and on ID only (for reducing API requests)
-def GetStatsID(SSID):
+# refresh makes sure the stats are up to date instead of possibly cached
+async def GetStatsID(SSID, priority=PriorityCommand, refresh=False):
     # Request the users profile
-    url = f"https://new.scoresaber.com/api/player/{str(SSID)}/basic"
-    PlayerData = json.loads(ApiCall(url))
+    url = f"{ApiBaseURL}/api/player/{str(SSID)}/basic"
+    PlayerData = json.loads(await CachedApiCall(url, CacheTTL["basic"], priority, refresh))
     # Removes unnecesary dict layer
-    PlayerData = PlayerData["playerInfo"]
-    # ScoreSaber is inconsistent on the roles, it might be "", it might be None. So we set it to "" if it's None
-    # If it's got content, set it to whatever the role is supposed to be
-    PlayerData["avatar"] = "https://new.scoresaber.com" + PlayerData["avatar"]
-    PlayerData["role"] = "" if PlayerData["role"] == "" or PlayerData["role"] is None else PlayerData["role"]
-    return PlayerData
+    player = ParsePlayer(PlayerData["playerInfo"])
+    Names.Remember(player.name, player.id)
+    return player
+
+# Gets a player's stats for a poll, without decoding the response if it's the same as last poll's
+# Returns (stats, changed), changed is False if the stats are the same ones the player had when last polled
+async def PollStatsID(SSID):
+    url = f"{ApiBaseURL}/api/player/{str(SSID)}/basic"
+    last = Changes.Get(SSID)
+    status, text, etag = await ApiRequest(url, PriorityPoll, None if last is None else last[1])
+    if status == 304 and last is not None:
+        Metrics.Count("poll_unchanged_total", (("check", "etag"),))
+        player, digest, etag = last[0], last[2], etag or last[1]
+    else:
+        if status == 200:
+            Cache.Set(url, text, CacheTTL["basic"])
+        # Same response as last time, no need to decode it
+        digest = Changes.Digest(text)
+        if last is not None and last[2] == digest:
+            Metrics.Count("poll_unchanged_total", (("check", "digest"),))
+            player = last[0]
+        else:
+            player = ParsePlayer(json.loads(text)["playerInfo"])
+    Names.Remember(player.name, player.id)
+    return player, Changes.Remember(SSID, player, etag, digest)
+
+# Turns a player off a leaderboard page into the parts the leaderboard index keeps
+def ParseLeaderboardEntry(player):
+    return {"rank": int(player["rank"]), "playerId": str(player["playerId"]), "playerName": str(player["playerName"]), "country": str(player["country"]), "pp": float(player["pp"])}
+
+# Gets a page of the global leaderboard, and keeps it in the leaderboard index if it's one of the top pages
+async def GetLeaderboardPage(page, priority=PriorityCommand, refresh=False):
+    return (await FetchLeaderboardPage(page, priority, refresh))[0]
+
+# Gets a page of the global leaderboard as (players, time ScoreSaber sent it), which is earlier than now if it came from the response cache
+async def FetchLeaderboardPage(page, priority=PriorityCommand, refresh=False):
+    url = f"{ApiBaseURL}/api/players/{page}"
+    players = json.loads(await CachedApiCall(url, CacheTTL["players"], priority, refresh))["players"]
+    fetched = Cache.FetchedAt(url, CacheTTL["players"]) or time.time()
+    Leaderboard.Update(page, players, fetched)
+    for player in players:
+        Names.Remember(player["playerName"], player["playerId"])
+    return players, fetched
 
 # Gets a random player off ScoreSaber leaderboards (from leaderboards 1 to 100, player rank 1 to 5000)
-def GetRandomPlayer():
-    url = "https://new.scoresaber.com/api/players/" + str(random.randint(1, 100))
-    leaderboard = json.loads(ApiCall(url))["players"]
-    return leaderboard[random.randint(0, 49)]
+async def GetRandomPlayer(priority=PriorityStatus):
+    player = Leaderboard.Random()
+    if player is None:
+        player = ParseLeaderboardEntry(random.choice(await GetLeaderboardPage(random.randint(1, 100), priority)))
+    return player
 
 # Gets the person currently on #1 global
-def GetNumberOneGlobal():
-    url = "https://new.scoresaber.com/api/players/1"
-    return json.loads(ApiCall(url))["players"][0]
+async def GetNumberOneGlobal(priority=PriorityStatus):
+    player = Leaderboard.Get(1)
+    if player is None:
+        player = ParseLeaderboardEntry((await GetLeaderboardPage(1, priority))[0])
+    return player
 
 # Randomly picks a status message
 def GetStatus():
@@ -158,104 +1531,300 @@ async def UpdateStatus(client):
     if choice == 1:
         statustext = GetStatus()
     elif choice == 2:
-        player = GetNumberOneGlobal()
+        player = await GetNumberOneGlobal()
     elif choice == 3:
-        player = GetRandomPlayer()
+        player = await GetRandomPlayer()
     if statustext == "":
         statustext = f"#{str(player['rank'])}: {player['playerName']} with {str(player['pp'])}pp"
     await client.change_presence(activity=discord.Game(name=f"{statustext} | SS!Help"))
 
-# Function to send everyone updates about their stats
-async def SendStatUpdates():
-    global IsUpdating
-    global ProfilePicture
-    # Make sure to tell other commands it's updating the stats
-    IsUpdating = True
-    # Cache messages before sending to not mess up updating stats when discord is down
-    Messages = []
-    with open("SSData.json", "r+") as f:
-        RegisteredPlayers = json.loads(f.read())
-    for n, Player in enumerate(RegisteredPlayers):
-        # Wait a bit here, Umbranox hates mass API usage
-        await asyncio.sleep(3)
-        NewPlayer = GetStatsID(Player["playerInfo"]["playerId"])
-        # This code is bad
-        # It creates 3 bools indicating that stats go beyond ranges the user has defined
-        CountryRankCheck = CheckThreshold(int(Player["playerInfo"]["countryRank"]), int(NewPlayer["countryRank"]), int(Player["countryRankThreshold"]))
-        GlobalRankCheck = CheckThreshold(int(Player["playerInfo"]["rank"]), int(NewPlayer["rank"]), int(Player["globalRankThreshold"]))
-        PPCheck = CheckThreshold(float(Player["playerInfo"]["pp"]), float(NewPlayer["pp"]), float(Player["ppThreshold"]))
-        # Then it checks if any of those are true
-        if CountryRankCheck or GlobalRankCheck or PPCheck:
+# Checks a single registration against freshly requested player stats
+# Returns the message to send as (channelId, ping, text, embed) if any threshold is reached, None otherwise
+def CheckRegistration(Player, NewPlayer):
+    OldPlayer = Player["playerInfo"]
+    # Same stats as last time (the most common case), nothing to check
+    if OldPlayer is NewPlayer:
+        return None
+    # Checks if any of the stats go beyond ranges the user has defined
+    CountryRankCheck = CheckThreshold(OldPlayer.countryRank, NewPlayer.countryRank, Player["countryRankThreshold"])
+    GlobalRankCheck = CheckThreshold(OldPlayer.rank, NewPlayer.rank, Player["globalRankThreshold"])
+    PPCheck = CheckThreshold(OldPlayer.pp, NewPlayer.pp, Player["ppThreshold"])
+    if CountryRankCheck or GlobalRankCheck or PPCheck:
+        # Poller workers aren't connected to Discord, the bot skips channels it can't find when sending instead
+        if not IsPollWorker:
             try:
                 # Try to get the channel from cache
                 UpdateChannel = client.get_channel(int(Player["channelId"]))
             except:
                 # If it fails in any way, just move on to the next player
-                continue
+                return
             if UpdateChannel == None:
                 # Discord.py likes to randomly return None instead of throwing an error
+                return
+
+        # If the user has selected to be pinged on status update
+        # Pings are kept apart from the text, so every ping in a batch of updates ends up on one line
+        if Player["ping"]:
+            ping = f"<@{Player['discordUserId']}>"
+        else:
+            ping = ""
+        MessageText = NewPlayer.name + "'s stats have changed!"
+        # If the player transitions from active to inactive
+        if OldPlayer.inactive == 0 and NewPlayer.inactive == 1:
+            MessageText += f"\n{OldPlayer.name} has been listed as inactive!"
+        # If the player transitions from normal to banned
+        if OldPlayer.banned == 0 and NewPlayer.banned == 1:
+            MessageText += f"\n{OldPlayer.name} has been listed as banned!"
+        # + if rank went up, - if rank went down, "" if rank is the same
+        GlobalIndicator = "+" if OldPlayer.rank - NewPlayer.rank > 0 else "-" if NewPlayer.rank - OldPlayer.rank > 0 else ""
+        CountryIndicator = "+" if OldPlayer.countryRank - NewPlayer.countryRank > 0 else "-" if NewPlayer.countryRank - OldPlayer.countryRank > 0 else ""
+        PPIndicator = "+" if OldPlayer.pp - NewPlayer.pp < 0 else "-" if OldPlayer.pp - NewPlayer.pp > 0 else ""
+        # Embed text
+        MessageEmbedText = f"Global Rank: `#{OldPlayer.rank}>#{NewPlayer.rank}` (`{GlobalIndicator}{abs(OldPlayer.rank - NewPlayer.rank)}`)\nCountry Rank (:flag_{NewPlayer.country.lower()}:{NewPlayer.country}): `#{OldPlayer.countryRank}>#{NewPlayer.countryRank}` (`{CountryIndicator}{abs(OldPlayer.countryRank - NewPlayer.countryRank)}`)\nPP: `{OldPlayer.pp}pp>{NewPlayer.pp}pp` (`{PPIndicator}{abs(round(NewPlayer.pp - OldPlayer.pp, 2))}`)\nLeaderboards: [Global](https://scoresaber.com/global/{GetScoreBoardNum(NewPlayer.rank)}) | [Country](https://scoresaber.com/global/{GetScoreBoardNum(NewPlayer.countryRank)}&country={NewPlayer.country.lower()})"
+        # Full embed object
+        MessageEmbed = GetEmbed("", MessageEmbedText).set_author(name=NewPlayer.name, url=f"https://scoresaber.com/u/{OldPlayer.id}", icon_url=NewPlayer.avatar).set_footer(icon_url=ProfilePicture, text=f"ID: {OldPlayer.id}")
+        # Overwrite player data
+        Player["playerInfo"] = NewPlayer
+        return (int(Player["channelId"]), ping, MessageText, MessageEmbed)
+    return None
+
+# Gets the name of the poller worker a player belongs to
+# Rendezvous hashing, so every worker agrees without talking to each other
+# Adding or removing a worker only moves the players that worker gains or loses, everyone else stays where they are
+def GetPlayerWorker(playerId, workers):
+    return max(workers, key=lambda worker: hashlib.blake2b(f"{worker}:{playerId}".encode(), digest_size=8).digest())
+
+# Gets the players this process should poll, out of every registered player in a cycle's snapshot
+async def GetOwnPlayers(Registered):
+    workers = await Store.GetWorkers()
+    # Before the first heartbeat is written (or when nobody else is running), everything is ours
+    if WorkerName not in workers:
+        workers.append(WorkerName)
+    if len(workers) == 1:
+        return Registered
+    return {playerId for playerId in Registered if GetPlayerWorker(playerId, workers) == WorkerName}
+
+# Gets up to date stats for due players from global leaderboard pages, 50 players per request
+# Leaderboards don't list country rank, inactive or banned, so only players whose global rank didn't change are taken from them
+# Being listed means they're active and not banned, and their country rank is assumed to be the same as last time
+# That's usually but not always true (someone from their country above them can go inactive while someone else passes them)
+# so every player still gets their own request at least every PollIntervalBasic seconds
+# Everyone else is left out of the result, and has to be requested separately
+async def RefreshFromLeaderboards(Due):
+    Grouped = {}
+    for PlayerId in Due:
+        seen = Poller.LastSeen(PlayerId)
+        if seen is not None and not PageRefresh.NeedsBasic(PlayerId):
+            Grouped.setdefault(GetScoreBoardNum(seen[0]), set()).add(PlayerId)
+    Fresh = {}
+    for page, PlayerIds in sorted(Grouped.items()):
+        # Every due player on a page whose rank changed still needs their own request, so most pages aren't worth it
+        if not PageRefresh.IsWorth(page, len(PlayerIds)):
+            continue
+        try:
+            players = await GetLeaderboardPage(page, PriorityPoll, refresh=True)
+        except Exception as ex:
+            print(ex)
+            continue
+        spared = 0
+        for player in players:
+            PlayerId = str(player["playerId"])
+            if PlayerId not in PlayerIds:
+                continue
+            seen = Poller.LastSeen(PlayerId)
+            if int(player["rank"]) != seen[0]:
                 continue
+            Fresh[PlayerId] = ParsePlayer(dict(player, countryRank=seen[1], inactive=0, banned=0))
+            spared += 1
+        PageRefresh.Record(page, len(PlayerIds), spared)
+    return Fresh
 
-            # If the user has selected to be pinged on status update
-            if Player["ping"]:
-                ping = f"<@{Player['discordUserId']}> "
-            else:
-                ping = ""
-            MessageText = ping + NewPlayer["playerName"] + "'s stats have changed!"
-            # If the player transitions from active to inactive
-            if int(Player["playerInfo"]["inactive"]) == 0 and NewPlayer["inactive"] == 1:
-                MessageText += f"\n{Player['playerInfo']['playerName']} has been listed as inactive!"
-            # If the player transitions from normal to banned
-            if int(Player["playerInfo"]["banned"]) == 0 and NewPlayer["banned"] == 1:
-                MessageText += f"\n{Player['playerInfo']['playerName']} has been listed as banned!"
-            # + if rank went up, - if rank went down, "" if rank is the same
-            GlobalIndicator = "+" if int(Player["playerInfo"]["rank"]) - int(NewPlayer["rank"]) > 0 else "-" if int(NewPlayer["rank"]) - int(Player["playerInfo"]["rank"]) > 0 else ""
-            CountryIndicator = "+" if int(Player["playerInfo"]["countryRank"]) - int(NewPlayer["countryRank"]) > 0 else "-" if int(NewPlayer["countryRank"]) - int(Player["playerInfo"]["countryRank"]) > 0 else ""
-            PPIndicator = "+" if float(Player["playerInfo"]["pp"]) - float(NewPlayer["pp"]) < 0 else "-" if float(Player["playerInfo"]["pp"]) - float(NewPlayer["pp"]) > 0 else ""
-            # Embed text
-            MessageEmbedText = f"Global Rank: `#{Player['playerInfo']['rank']}>#{NewPlayer['rank']}` (`{GlobalIndicator}{abs(Player['playerInfo']['rank'] - NewPlayer['rank'])}`)\nCountry Rank (:flag_{NewPlayer['country'].lower()}:{NewPlayer['country']}): `#{Player['playerInfo']['countryRank']}>#{NewPlayer['countryRank']}` (`{CountryIndicator}{abs(Player['playerInfo']['countryRank'] - NewPlayer['countryRank'])}`)\nPP: `{Player['playerInfo']['pp']}pp>{NewPlayer['pp']}pp` (`{PPIndicator}{abs(round(NewPlayer['pp'] - float(Player['playerInfo']['pp']), 2))}`)\nLeaderboards: [Global](https://scoresaber.com/global/{str(GetScoreBoardNum(NewPlayer['rank']))}) | [Country](https://scoresaber.com/global/{str(GetScoreBoardNum(NewPlayer['countryRank']))}&country={NewPlayer['country'].lower()})"
-            # Full embed object
-            MessageEmbed = GetEmbed("", MessageEmbedText).set_author(name=NewPlayer['playerName'], url=f"https://scoresaber.com/u/{Player['playerInfo']['playerId']}", icon_url=NewPlayer['avatar']).set_footer(icon_url=ProfilePicture, text=f"ID: {Player['playerInfo']['playerId']}")
-            # Append message for later use
-            Messages.append([UpdateChannel, MessageText, MessageEmbed])
-            Player["playerInfo"] = NewPlayer
-            # Overwrite player data
-            RegisteredPlayers[n] = Player
-    with open("SSData.json", "w+") as f:
-        f.write(json.dumps(RegisteredPlayers, indent=4))
-
-    # After updating all the players stats and saving them to a file, send messages
-    for message in Messages:
-        # Wait a couple seconds per update, discord doesn't like spamming
-        await asyncio.sleep(2)
+# Function to send everyone updates about their stats
+# Polls a snapshot of the registrations, so registering and unregistering never has to wait for (or be turned away by) a cycle
+async def SendStatUpdates():
+    # Poller workers only find out about new and removed registrations from the database
+    if IsPollWorker:
+        await Registry.Reload()
+    Registered = Registry.StartCycle()
+    try:
+        await PollRegistrations(Registered)
+    finally:
+        MergeRegistrationChanges(Registry.EndCycle())
+    # Whoever polls frees the history of players nobody is registered to anymore, the bot doesn't poll when it has workers
+    await History.Free()
+
+# Catches the poller up on registrations added or removed during a cycle
+# New players have no schedule yet, so they're due first thing next cycle, players nobody is registered to anymore are forgotten
+def MergeRegistrationChanges(Log):
+    if any(Player is None and key[2] not in Registry.ByPlayer for key, Player in Log):
+        Poller.Prune(Registry.ByPlayer)
+        Changes.Prune(Registry.ByPlayer)
+        PageRefresh.Prune(Registry.ByPlayer)
+
+# Polls the due players out of a snapshot of the registrations, as {playerId: (registration, ...)}
+async def PollRegistrations(Registered):
+    global ProfilePicture
+    # The same player can be registered in many channels or by many users
+    # Every player is only requested once per update, no matter how many registrations they have
+    # With several poller workers, each one only polls its own share of the players
+    OwnPlayers = await GetOwnPlayers(Registered)
+    Poller.Prune(OwnPlayers)
+    Changes.Prune(OwnPlayers)
+    PageRefresh.Prune(OwnPlayers)
+    # Pick up where the last window stopped if it was interrupted, players polled before that aren't polled again
+    Due = [PlayerId for PlayerId in await Store.GetCycle() if PlayerId in OwnPlayers]
+    if not Due:
+        Due = Poller.Due(list(OwnPlayers), time.time() + PollWindow)
+    await Store.StartCycle(Due)
+    # Players close together on the leaderboards are refreshed a page at a time
+    Fresh = await RefreshFromLeaderboards(Due)
+    Remaining = [PlayerId for PlayerId in Due if PlayerId not in Fresh]
+    # Spread the requests evenly over the window instead of sending them all at once
+    Start = time.monotonic()
+    Spacing = PollWindow / max(1, len(Remaining))
+    # Unchanged players are marked as done for the window a batch at a time, instead of a write each
+    Finished = []
+    for n, PlayerId in enumerate(list(Fresh.keys()) + Remaining):
+        if PlayerId in Fresh:
+            NewPlayer = Fresh[PlayerId]
+            Updated = Changes.Remember(PlayerId, NewPlayer)
+        else:
+            await asyncio.sleep(max(0, Start + (n - len(Fresh)) * Spacing - time.monotonic()))
+            try:
+                # Umbranox hates mass API usage, the scheduler spaces these out and lets commands go first
+                NewPlayer, Updated = await PollStatsID(PlayerId)
+                PageRefresh.Polled(PlayerId)
+            except Exception as ex:
+                # One bad response shouldn't stop everyone else from being updated, this player is tried again next window
+                print(ex)
+                await Store.Checkpoint(PlayerId, None, [], [])
+                continue
+        Metrics.Mark("players_polled")
+        Metrics.Count("players_polled_total", (("source", "leaderboard" if PlayerId in Fresh else "basic"),))
+        seen = Poller.LastSeen(PlayerId)
+        if PlayerId not in Fresh and seen is not None:
+            PageRefresh.Record(GetScoreBoardNum(seen[0]), 1, NewPlayer.rank == seen[0])
+        Registrations = Registered.get(PlayerId, ())
+        Changed = []
+        Messages = []
+        for Player in Registrations:
+            OldPlayer = Player["playerInfo"]
+            message = CheckRegistration(Player, NewPlayer)
+            if message is not None:
+                Changed.append((Player, OldPlayer))
+                Messages.append(message)
+        Poller.Update(PlayerId, NewPlayer, Registrations)
+        await History.Append(NewPlayer)
+        # Same stats as last poll and nobody to notify, there is nothing new to save
+        if not Updated and not Messages:
+            Finished.append(PlayerId)
+            if len(Finished) >= 100:
+                await Store.FinishCycle(Finished)
+                Finished = []
+            continue
+        # Save right away, so a crash or restart doesn't throw away this player's update
+        Saved = await Registry.Checkpoint(PlayerId, NewPlayer, Changed, Messages)
+        # Send it right away, the player doesn't have to wait for everyone else to be polled
+        # Poller workers leave sending to the bot, which picks the saved messages up
+        if not IsPollWorker:
+            for message, notificationId in Saved:
+                Delivery.Put(*message, notificationId)
+    if Finished:
+        await Store.FinishCycle(Finished)
+
+# Sends messages saved by poller workers, and ones saved but not sent before the bot stopped
+async def NotificationRoutine():
+    LastId = 0
+    while True:
         try:
-            channel = message[0]
-            await channel.send(message[1], embed=message[2])
-        except:
-            pass
-    # Tell commands updating process is done
-    IsUpdating = False
+            for notificationId, channelId, ping, text, embed, registration in await Store.GetNotifications(LastId):
+                LastId = notificationId
+                # Keep the registration in memory in line with what the worker notified about, for SS!List
+                if registration is not None:
+                    Registry.Apply(registration)
+                Delivery.Put(channelId, ping, text, embed, notificationId)
+        except Exception as ex:
+            print(ex)
+        await asyncio.sleep(1)
+
+# Keeps this process' heartbeat going, and splits the API budget between the processes using it
+# Every running worker gets an equal share, the bot keeps one for commands when it doesn't poll itself
+async def HeartbeatRoutine():
+    polling = IsPollWorker or PollWorkers == 0
+    while True:
+        try:
+            workers = await Store.Heartbeat(WorkerName if polling else None)
+            Scheduler.SetShare(1 / max(1, len(workers) + (0 if "bot" in workers else 1)))
+            Metrics.Set("poll_workers", len(workers))
+        except Exception as ex:
+            print(ex)
+        await asyncio.sleep(WorkerHeartbeat)
+
+# Starts the poller worker processes
+def StartPollWorkers():
+    return [subprocess.Popen([sys.executable, os.path.abspath(__file__), "--poll-worker", f"worker{n}"]) for n in range(1, PollWorkers + 1)]
+
+# Polls players every window until the process stops
+async def PollRoutine():
+    while True:
+        Start = time.monotonic()
+        try:
+            await SendStatUpdates()
+        except Exception as ex:
+            Metrics.Count("poll_cycle_errors_total")
+            print(ex)
+        Metrics.Observe("poll_cycle_seconds", time.monotonic() - Start)
+        # Start the next window once this one is over, players decide themselves whether they're due
+        await asyncio.sleep(max(0, PollWindow - (time.monotonic() - Start)))
+
+# Everything a poller worker process does, it never connects to Discord
+async def PollWorkerMain():
+    # Let the other workers see this one before picking which players are ours
+    await Store.Heartbeat(WorkerName)
+    await asyncio.sleep(WorkerHeartbeat)
+    asyncio.get_event_loop().create_task(HeartbeatRoutine())
+    asyncio.get_event_loop().create_task(MetricsRoutine())
+    asyncio.get_event_loop().create_task(StateRoutine())
+    await WaitForState()
+    await PollRoutine()
 
 # Update stats on a time interval
 async def StatUpdateRoutine():
     global StatUpdateRunning
-    global IsUpdating
     await client.wait_until_ready()
     StatUpdateRunning = True
+    client.loop.create_task(NotificationRoutine())
+    client.loop.create_task(HeartbeatRoutine())
+    client.loop.create_task(StateRoutine())
+    # Poller workers do the polling, the bot only sends what they found
+    if PollWorkers > 0:
+        client.PollWorkers = StartPollWorkers()
+        return
+    # Players polled shortly before the restart aren't due yet
+    await WaitForState()
+    await PollRoutine()
+
+# Refreshes the leaderboard index a page at a time, the page that was refreshed longest ago first
+async def LeaderboardRoutine():
+    global LeaderboardRunning
+    LeaderboardRunning = True
+    await WaitForState()
     while True:
-        try:
-            await SendStatUpdates()
-        except Exception as ex:
-            print(ex)
-        IsUpdating = False
-        # Update stats once every 30 minutes
-        await asyncio.sleep(1800)
+        page = Leaderboard.Stalest()
+        # Pages that were loaded recently anyway (by polling or commands) don't need to be requested again
+        if time.time() - Leaderboard.Updated[page - 1] >= LeaderboardRefresh:
+            try:
+                await GetLeaderboardPage(page, PriorityStatus, refresh=True)
+            except Exception as ex:
+                print(ex)
+        await asyncio.sleep(LeaderboardRefresh / Leaderboard.Pages)
 
 # Update discord bot status on a time interval
 async def StatusUpdateRoutine():
     global StatusUpdateRunning
     await client.wait_until_ready()
     StatusUpdateRunning = True
+    await WaitForState()
     while True:
         try:
             await UpdateStatus(client)
@@ -264,294 +1833,551 @@ async def StatusUpdateRoutine():
         # Update status once every 10 minutes
         await asyncio.sleep(600)
 
-class MyClient(discord.Client):
+# Writes a file atomically, so whatever reads it never sees half a file
+def WriteFileAtomic(path, text):
+    with open(path + ".tmp", "wb" if isinstance(text, bytes) else "w") as f:
+        f.write(text)
+    os.replace(path + ".tmp", path)
 
-    async def on_ready(self):
-        global StatUpdateRunning
-        global StatusUpdateRunning
-        print(f"Logged in as {str(self.user)}")
-        if not StatUpdateRunning:
-            bg_task = client.loop.create_task(StatUpdateRoutine())
-        if not StatusUpdateRunning:
-            bg_task2 = client.loop.create_task(StatusUpdateRoutine())
+# Gets the runtime state worth keeping across restarts
+# Registrations, player names, history and unsent messages are in the database already
+# Copied on the event loop, so it can be written on another thread without anything changing underneath it
+def GetState():
+    now = time.monotonic()
+    return {
+        "version": 2,
+        "saved": time.time(),
+        # playerId: [next poll time, interval, (rank, countryRank, pp)]
+        "poller": dict(Poller.Players),
+        # playerId: time of their last own request
+        "basic": dict(PageRefresh.LastBasic),
+        # playerId: (stats, ETag, response digest) of their last response, so the first poll after a restart can still be a 304
+        "changes": {playerId: (snapshot.Values(), etag, None if digest is None else digest.hex()) for playerId, (snapshot, etag, digest) in Changes.Players.items()},
+        "leaderboard": (Leaderboard.Pages, list(Leaderboard.Entries), list(Leaderboard.Updated)),
+        # (url, seconds left, response text)
+        "cache": [(url, expiry - now, text) for url, (expiry, text) in Cache.Entries.items() if expiry > now]
+    }
 
-    async def on_message(self, message):
-        global IsUpdating
-        global HelpMessages
-        global Changelog
-        global SupportServer
-        global ProfilePicture
-        global SourceURL
-        # If any bot sends a message
-        if message.author.bot:
-            return
-        # If the message is not a command
-        if not message.content.lower().startswith("ss!"):
-            return
-        # Send link to license
-        if message.content.lower() == "ss!license":
-            await message.channel.send("https://www.gnu.org/licenses/gpl-3.0.txt")
-        # Help command
-        if message.content.lower().startswith("ss!help"):
-            splitcontent = message.content.split(" ")
-            if len(splitcontent) == 1:
-                # No command specified, send command list
-                await message.channel.send(content="", embed=GetEmbedWithSupportLink("Command List", HelpMessages["help"] + f"\n[Source Code]({SourceURL})"))
-            elif len(splitcontent) == 2:
-                HelpString = splitcontent[1].split("!")[-1].lower()
-                if HelpString in HelpMessages.keys():
-                    await message.channel.send(content="", embed=GetEmbed(f"SS!{HelpString[0].upper()}{HelpString[1:]}", HelpMessages[HelpString]))
-                else:
-                    await message.channel.send("Unknown command!")
-
-        # Get info about a user
-        if message.content.lower().startswith("ss!info"):
-            # Split arguments
-            splitcontent = message.content.split(" ")
-            # If no arguments are given
-            if len(splitcontent) < 2:
-                await message.channel.send("Please provide a ScoreSaber Name, UID, or URL!\nExamples: `SS!Info https://scoresaber.com/u/76561198161040596`\n`SS!Info Taichidesu`")
-                return
-            # Catch KeyError (thrown by GetPlayerProfileAll and passed by GetStats)
+# Writes the state as compressed JSON, only data, so a replaced or broken state file can't do anything but fail to load
+def WriteState(path, state):
+    WriteFileAtomic(path, zlib.compress(json.dumps(state, separators=(",", ":")).encode()))
+
+def ReadState(path):
+    if not os.path.exists(path):
+        return None
+    with open(path, "rb") as f:
+        return json.loads(zlib.decompress(f.read()))
+
+# Saves the runtime state, writing it on another thread
+async def SaveState():
+    if StatePath:
+        await asyncio.get_event_loop().run_in_executor(None, WriteState, StatePath, GetState())
+
+# Takes over saved state, anything that's already known since startup wins
+def ApplyState(state):
+    if state is None or state.get("version") != 2:
+        return
+    for playerId, (NextPoll, interval, seen) in state["poller"].items():
+        Poller.Players.setdefault(playerId, [NextPoll, interval, tuple(seen)])
+    # The earliest time wins, a restart doesn't count as a request of their own
+    for playerId, polled in state["basic"].items():
+        PageRefresh.LastBasic[playerId] = min(polled, PageRefresh.LastBasic.get(playerId, polled))
+    for playerId, (values, etag, digest) in state["changes"].items():
+        if Changes.Get(playerId) is None:
+            Changes.Players[playerId] = (InternPlayer(*values), etag, None if digest is None else bytes.fromhex(digest))
+    pages, entries, updated = state["leaderboard"]
+    for n in range(min(pages, Leaderboard.Pages)):
+        if updated[n] > Leaderboard.Updated[n]:
+            Leaderboard.Entries[n * 50:(n + 1) * 50] = entries[n * 50:(n + 1) * 50]
+            Leaderboard.Updated[n] = updated[n]
+    # Cached responses only count as long as they would have without the restart
+    passed = time.time() - state["saved"]
+    for url, left, text in state["cache"]:
+        if left > passed and url.startswith(ApiBaseURL) and Cache.Get(url) is None:
+            Cache.Set(url, text, left - passed)
+    print(f"Restored {len(state['poller'])} poll schedules, {sum(1 for n in updated if n > 0)} leaderboard pages and {len(state['cache'])} cached responses")
+
+# Loads the state saved before the last restart, reading and unpacking it on another thread
+async def RestoreState():
+    if not StatePath:
+        return
+    try:
+        ApplyState(await asyncio.get_event_loop().run_in_executor(None, ReadState, StatePath))
+    except Exception as ex:
+        print(ex)
+
+# Waits until the saved state has been restored, the first caller starts restoring it
+# Everything that would otherwise make requests right after startup waits on this, so a restart doesn't poll everyone again
+async def WaitForState():
+    global StateRestore
+    if StateRestore is None:
+        StateRestore = asyncio.get_event_loop().create_task(RestoreState())
+    await asyncio.shield(StateRestore)
+
+# Saves the runtime state on a time interval
+async def StateRoutine():
+    await WaitForState()
+    while True:
+        await asyncio.sleep(StateInterval)
+        try:
+            await SaveState()
+        except Exception as ex:
+            print(ex)
+
+# Measures how late the event loop wakes up, and writes the metrics file on a time interval
+async def MetricsRoutine():
+    global MetricsRunning
+    MetricsRunning = True
+    LastWrite = time.monotonic()
+    while True:
+        start = time.monotonic()
+        await asyncio.sleep(1)
+        # Anything over a second is time the event loop was busy with something else
+        lag = time.monotonic() - start - 1
+        Metrics.Set("event_loop_lag_seconds", lag)
+        Metrics.Observe("event_loop_lag_seconds_histogram", lag)
+        Metrics.Set("api_requests_last_minute", Metrics.PerMinute("api_requests"))
+        Metrics.Set("players_polled_last_minute", Metrics.PerMinute("players_polled"))
+        Metrics.Set("registrations", len(Registry.ByKey))
+        Metrics.Set("tracked_players", len(Registry.ByPlayer))
+        Metrics.Set("leaderboard_pages_loaded", sum(1 for updated in Leaderboard.Updated if updated > 0))
+        if MetricsFile and time.monotonic() - LastWrite >= MetricsInterval:
+            LastWrite = time.monotonic()
             try:
-                player = GetSSProfileAll(' '.join(splitcontent[1:]))
-                player = GetStatsID(player["playerId"])
-            except KeyError:
-                await message.channel.send("That user doesn't exist!")
-                return
-            # Send the message
-            await message.channel.send(content="", embed=GetEmbed("", f"Global Rank: `#{str(player['rank'])}`\nCountry Rank (:flag_{player['country'].lower()}:{player['country']}): `#{str(player['countryRank'])}`\nPP: `{str(player['pp'])}pp`\nLeaderboards: [Global](https://scoresaber.com/global/{str(GetScoreBoardNum(player['rank']))}) | [Country](https://scoresaber.com/global/{str(GetScoreBoardNum(player['countryRank']))}&country={player['country'].lower()})").set_author(name=player['playerName'], url=f"https://scoresaber.com/u/{player['playerId']}", icon_url=player["avatar"]).set_footer(icon_url=ProfilePicture, text=f"ID: {player['playerId']}"))
+                await asyncio.get_event_loop().run_in_executor(None, WriteFileAtomic, MetricsFile, Metrics.Render())
+            except Exception as ex:
+                print(ex)
+
+# Builds the text for SS!Stats
+def GetStatsText():
+    text = f"Uptime: `{round((time.time() - Metrics.Started) / 3600, 1)}h`\n"
+    text += f"API budget: `{Metrics.PerMinute('api_requests')}/{ApiRequestsPerMinute}` requests in the last minute\n"
+    for labels in Metrics.LabelsOf("api_request_seconds"):
+        count, total = Metrics.Summary("api_request_seconds", labels)
+        endpoint = dict(labels)["endpoint"]
+        errors = Metrics.Counters.get(("api_errors_total", labels), 0)
+        ratelimited = Metrics.Counters.get(("api_requests_total", labels + (("status", 429),)), 0)
+        text += f"`{endpoint}`: `{count}` requests, avg `{round(total / max(1, count) * 1000)}ms`, p95 `{Metrics.Quantile('api_request_seconds', labels, 0.95)}s`, `{ratelimited}` 429s, `{errors}` errors\n"
+    hits = sum(value for (name, labels), value in Metrics.Counters.items() if name in ("cache_hits_total", "cache_shared_total"))
+    misses = sum(value for (name, labels), value in Metrics.Counters.items() if name == "cache_misses_total")
+    text += f"Cache hit rate: `{round(hits / max(1, hits + misses) * 100, 1)}%`\n"
+    count, total = Metrics.Summary("poll_cycle_seconds", ())
+    text += f"Poll windows: `{count}`, avg `{round(total / max(1, count))}s`, players polled in the last minute: `{Metrics.PerMinute('players_polled')}`\n"
+    count, total = Metrics.Summary("discord_send_seconds", ())
+    text += f"Discord sends: `{count}`, avg `{round(total / max(1, count) * 1000)}ms`, `{Metrics.Counters.get(('discord_send_errors_total', ()), 0)}` errors, `{sum(len(queue) for queue in Delivery.Queues.values())}` queued\n"
+    text += f"Event loop lag: `{round(Metrics.Gauges.get(('event_loop_lag_seconds', ()), 0) * 1000)}ms`, p99 `{Metrics.Quantile('event_loop_lag_seconds_histogram', (), 0.99)}s`\n"
+    for labels in Metrics.LabelsOf("command_seconds"):
+        count, total = Metrics.Summary("command_seconds", labels)
+        text += f"`{dict(labels)['command']}`: `{count}` uses, p99 `{Metrics.Quantile('command_seconds', labels, 0.99)}s`\n"
+    return text
+
+# Commands currently being worked on, by (command, argument)
+CommandsInFlight = {}
+
+# The cooldown reservation of the command the current task is handling, see CommandCooldowns.Reserve
+# Commands only count as used once they make a ScoreSaber request, so mistyped commands and local lookups are free
+CommandUse = contextvars.ContextVar("CommandUse", default=None)
+
+# Keeps users and channels from spending the API budget faster than everyone else
+class CommandCooldowns:
+    def __init__(self, UserSeconds, ChannelSeconds):
+        self.UserSeconds = UserSeconds
+        self.ChannelSeconds = ChannelSeconds
+        # (command, userId or channelId): last time it was used
+        self.LastUsed = {}
+
+    # Gets the seconds left before a command can be used again, 0 if it can be used right now
+    def Check(self, command, userId, channelId):
+        return max(0, max(self.LastUsed.get((command, "user", userId), -3600) + self.UserSeconds, self.LastUsed.get((command, "channel", channelId), -3600) + self.ChannelSeconds) - time.monotonic())
+
+    # Starts a command's cooldown right away, so the same user can't get several in at once
+    # Returns the reservation as [time, [(key, time it was used before)], whether it asked ScoreSaber], which is refunded if it didn't
+    def Reserve(self, command, userId, channelId):
+        now = time.monotonic()
+        # Forget uses that no longer matter, so this doesn't grow forever
+        if len(self.LastUsed) > 10000:
+            self.LastUsed = {key: used for key, used in self.LastUsed.items() if used > now - max(self.UserSeconds, self.ChannelSeconds)}
+        keys = ((command, "user", userId), (command, "channel", channelId))
+        reservation = [now, [(key, self.LastUsed.get(key)) for key in keys], False]
+        for key in keys:
+            self.LastUsed[key] = now
+        return reservation
+
+    # Takes back a reservation of a command that never asked ScoreSaber, unless the command was used again since
+    def Refund(self, reservation):
+        now, previous, used = reservation
+        if used:
             return
+        for key, before in previous:
+            if self.LastUsed.get(key) != now:
+                continue
+            if before is None:
+                del self.LastUsed[key]
+            else:
+                self.LastUsed[key] = before
 
-        # Register command
-        if message.content.lower().startswith("ss!register"):
-            # If the stats are being updated
-            if IsUpdating:
-                await message.channel.send("Sorry, the bot is currently updating everyone's stats. Please try again in a minute.")
-                return
-            # If in DMs
-            if message.channel.type == "private":
-                await message.channel.send("DM support is disabled. Ask in the support server for more info")
-                return
-            splitcontent = message.content.split(" ")
-            # If no arguments were provided
-            if len(splitcontent) < 2:
-                await message.channel.send("Please provide a ScoreSaber Name, UID, or URL!\nExamples: `SS!Register https://scoresaber.com/u/76561198333869741`\n`SS!Register Taichidesu`")
-                return
-            # Catch keyerror for non-existant user
+Cooldowns = CommandCooldowns(CommandCooldownUser, CommandCooldownChannel)
+
+# Runs the work of a command once, for everyone asking the same thing at the same time
+async def CollapseCommand(key, factory):
+    if key in CommandsInFlight:
+        Metrics.Count("commands_collapsed_total", (("command", key[0]),))
+    return await SingleFlight(CommandsInFlight, key, factory)
+
+# Performance stats, only for the owner
+async def CommandStats(message, splitcontent):
+    if message.author.id != client.OwnerId:
+        return
+    await message.channel.send(content="", embed=GetEmbed("Stats", GetStatsText()))
+
+# Send link to license
+async def CommandLicense(message, splitcontent):
+    await message.channel.send("https://www.gnu.org/licenses/gpl-3.0.txt")
+
+# Help command
+async def CommandHelp(message, splitcontent):
+    if len(splitcontent) == 1:
+        # No command specified, send command list
+        await message.channel.send(content="", embed=GetEmbedWithSupportLink("Command List", HelpMessages["help"] + f"\n[Source Code]({SourceURL})"))
+    elif len(splitcontent) == 2:
+        HelpString = splitcontent[1].split("!")[-1].lower()
+        if HelpString in HelpMessages.keys():
+            await message.channel.send(content="", embed=GetEmbed(f"SS!{HelpString[0].upper()}{HelpString[1:]}", HelpMessages[HelpString]))
+        else:
+            await message.channel.send("Unknown command!")
+
+# Get info about a user
+async def CommandInfo(message, splitcontent):
+    # If no arguments are given
+    if len(splitcontent) < 2:
+        await message.channel.send("Please provide a ScoreSaber Name, UID, or URL!\nExamples: `SS!Info https://scoresaber.com/u/76561198161040596`\n`SS!Info Taichidesu`")
+        return
+    ssplayer = ' '.join(splitcontent[1:])
+    # Everyone asking about the same player at the same time shares one lookup
+    embed = await CollapseCommand(("info", ssplayer.lower()), lambda: GetInfoEmbed(ssplayer))
+    if embed is None:
+        await message.channel.send("That user doesn't exist!")
+        return
+    # Send the message
+    await message.channel.send(content="", embed=embed)
+
+# Gets the SS!Info embed of a player, or None if they don't exist
+async def GetInfoEmbed(ssplayer):
+    # Catch KeyError (thrown by GetSSPlayerID and passed by GetStats)
+    try:
+        player = await GetStatsID(await GetSSPlayerID(ssplayer))
+    except KeyError:
+        return None
+    return GetEmbed("", f"Global Rank: `#{player.rank}`\nCountry Rank (:flag_{player.country.lower()}:{player.country}): `#{player.countryRank}`\nPP: `{player.pp}pp`\nLeaderboards: [Global](https://scoresaber.com/global/{GetScoreBoardNum(player.rank)}) | [Country](https://scoresaber.com/global/{GetScoreBoardNum(player.countryRank)}&country={player.country.lower()})").set_author(name=player.name, url=f"https://scoresaber.com/u/{player.id}", icon_url=player.avatar).set_footer(icon_url=ProfilePicture, text=f"ID: {player.id}")
+
+# Register command
+async def CommandRegister(message, splitcontent):
+    # If in DMs
+    if message.channel.type == "private":
+        await message.channel.send("DM support is disabled. Ask in the support server for more info")
+        return
+    # If no arguments were provided
+    if len(splitcontent) < 2:
+        await message.channel.send("Please provide a ScoreSaber Name, UID, or URL!\nExamples: `SS!Register https://scoresaber.com/u/76561198333869741`\n`SS!Register Taichidesu`")
+        return
+    # Catch keyerror for non-existant user
+    try:
+        # We *have* to request information by ID here.
+        # Player data by name search does not get the same info as /basic endpoint
+        player = await GetStatsID(await GetSSPlayerID(splitcontent[1]))
+    except KeyError:
+        await message.channel.send("That user doesn't exist!")
+        return
+    if Registry.Get(message.channel.id, message.author.id, player.id) is not None:
+        await message.channel.send("This player is already registered!")
+        return
+    # Default settings
+    ping = True
+    GlobalRankThreshold = 1
+    CountryRankThreshold = 1
+    PPThreshold = 0.01
+    # Parse settings (Hello r/badcode!)
+    for n, arg in enumerate(splitcontent):
+        # SS!Register (player) (args)
+        # If we're at the args
+        if n > 1:
+            # Split the argument name
             try:
-                player = GetSSProfileAll(splitcontent[1])
-                # We *have* to re-request information here.
-                # Player data by name search does not get the same info as /basic endpoint
-                # Since it's only required here (during checkups we use ID), we only re-request here.
-                player = GetStatsID(player["playerId"])
-            except KeyError:
-                await message.channel.send("That user doesn't exist!")
-                return
-            with open("SSData.json", "r+") as f:
-                FullData = json.loads(f.read())
-            for RegisteredPlayer in FullData:
-                if RegisteredPlayer["channelId"] == message.channel.id and RegisteredPlayer["discordUserId"] == message.author.id and RegisteredPlayer["playerInfo"]["playerId"] == player["playerId"]:
-                    await message.channel.send("This player is already registered!")
+                argname = arg.split("=")[0]
+                argvalue = arg.split("=")[1]
+            except:
+                # If it was broken somehow, like invalid syntax, just move on to the next arg.
+                continue
+            if argname == "ping":
+                # Check if the user supplied "Yes", "True" or any variation of those
+                ping = IsYes(argvalue)
+            elif argname == "globalRankThreshold":
+                # Catch exception if argument value isn't a valid integer
+                try:
+                    GlobalRankThreshold = int(argvalue)
+                    # If the threshold is below 0, it triggers every update.
+                    if GlobalRankThreshold <= 0:
+                        await message.channel.send("Wrong value for globalRankThreshold! Must be more than 0!")
+                        return
+                except:
+                    await message.channel.send("Wrong value for globalRankThreshold! Must be a number!")
                     return
-            # Default settings
-            ping = True
-            GlobalRankThreshold = 1
-            CountryRankThreshold = 1
-            PPThreshold = 0.01
-            # Parse settings (Hello r/badcode!)
-            for n, arg in enumerate(splitcontent):
-                # SS!Register (player) (args)
-                # If we're at the args
-                if n > 1:
-                    # Split the argument name
-                    try:
-                        argname = arg.split("=")[0]
-                        argvalue = arg.split("=")[1]
-                    except:
-                        # If it was broken somehow, like invalid syntax, just move on to the next arg.
-                        continue
-                    if argname == "ping":
-                        # Check if the user supplied "Yes", "True" or any variation of those
-                        ping = IsYes(argvalue)
-                    elif argname == "globalRankThreshold":
-                        # Catch exception if argument value isn't a valid integer
-                        try:
-                            GlobalRankThreshold = int(argvalue)
-                            # If the threshold is below 0, it triggers every update.
-                            if GlobalRankThreshold <= 0:
-                                await message.channel.send("Wrong value for globalRankThreshold! Must be more than 0!")
-                                return
-                        except:
-                            await message.channel.send("Wrong value for globalRankThreshold! Must be a number!")
-                            return
-                    elif argname == "countryRankThreshold":
-                        try:
-                            CountryRankThreshold = int(argvalue)
-                            if CountryRankThreshold <= 0:
-                                await message.channel.send("Wrong value for countryRankThreshold! Must be more than 0!")
-                                return
-                        except:
-                            await message.channel.send("Wrong value for countryRankThreshold! Must be a number!")
-                            return
-                    elif argname == "ppThreshold":
-                        try:
-                            PPThreshold = float(argvalue)
-                            if PPThreshold <= 0.0:
-                                await message.channel.send("Wrong value for ppThreshold! Must be more than 0!")
-                                return
-                        except:
-                            await message.channel.send("Wrong value for ppThreshold! Must be a number!")
-                            return
-                    else:
-                        await message.channel.send(f"Unknown Argument `{argname}`!")
+            elif argname == "countryRankThreshold":
+                try:
+                    CountryRankThreshold = int(argvalue)
+                    if CountryRankThreshold <= 0:
+                        await message.channel.send("Wrong value for countryRankThreshold! Must be more than 0!")
                         return
-            # Add the new player into the list
-            NewPlayer = {"playerInfo": player, "channelId": message.channel.id, "discordUserId": message.author.id, "ping": ping, "globalRankThreshold": GlobalRankThreshold, "countryRankThreshold": CountryRankThreshold, "ppThreshold": PPThreshold}
-            with open("SSData.json", "w+") as f:
-                FullData.append(NewPlayer)
-                f.write(json.dumps(FullData, indent=4))
-            # Notify the user of it being added
-            await message.channel.send(f"{message.author.mention} You will get notified in this channel when {NewPlayer['playerInfo']['playerName']}'s rank or pp changes.\nSettings:\n`Ping`: `{'Yes' if ping else 'No'}`\n`Global Rank Threshold`: `{GlobalRankThreshold}`\n`Country Rank Threshold`: `{CountryRankThreshold}`\n`PP Threshold`: `{PPThreshold}`")
-            return
-
-        if message.content.lower().startswith("ss!unregister"):
-            if IsUpdating:
-                await message.channel.send("Sorry, the bot is currently updating everyone's stats. Please try again in a minute.")
-                return
-            splitcontent = message.content.split(" ")
-            # If no name, id, or url was provided
-            if len(splitcontent) < 2:
-                await message.channel.send("Please provide a ScoreSaber Name, UID, or URL!\nExamples: `SS!UnRegister https://scoresaber.com/u/76561198333869741`\n`SS!UnRegsiter Taichidesu`")
-                return
-            # Get player stats on everything after the command
-            try:
-                player = GetSSProfileAll(' '.join(splitcontent[1:]))
-            except KeyError:
-                await message.channel.send("That player doesn't exist!")
-                return
-            with open("SSData.json", "r+") as f:
-                FullData = json.loads(f.read())
-            # Remove the player in this channel by this user with the given player id
-            for RegisteredPlayer in FullData:
-                if RegisteredPlayer["channelId"] == message.channel.id and RegisteredPlayer["discordUserId"] == message.author.id and RegisteredPlayer["playerInfo"]["playerId"] == str(player["playerId"]):
-                    FullData.remove(RegisteredPlayer)
-                    with open("SSData.json", "w+") as f:
-                        f.write(json.dumps(FullData, indent=4))
-                        await message.channel.send(f"{message.author.mention} You will no longer get notified in this channel when {RegisteredPlayer['playerInfo']['playerName']}'s rank or pp changes.")
+                except:
+                    await message.channel.send("Wrong value for countryRankThreshold! Must be a number!")
                     return
-            # No return means we didn't find anything at this point
-            await message.channel.send("That player is not registered in this channel!")
-            return
+            elif argname == "ppThreshold":
+                try:
+                    PPThreshold = float(argvalue)
+                    if PPThreshold <= 0.0:
+                        await message.channel.send("Wrong value for ppThreshold! Must be more than 0!")
+                        return
+                except:
+                    await message.channel.send("Wrong value for ppThreshold! Must be a number!")
+                    return
+            else:
+                await message.channel.send(f"Unknown Argument `{argname}`!")
+                return
+    # Add the new player into the list
+    NewPlayer = {"playerInfo": player, "channelId": message.channel.id, "discordUserId": message.author.id, "ping": ping, "globalRankThreshold": GlobalRankThreshold, "countryRankThreshold": CountryRankThreshold, "ppThreshold": PPThreshold}
+    await Registry.Add(NewPlayer)
+    # Notify the user of it being added
+    await message.channel.send(f"{message.author.mention} You will get notified in this channel when {player.name}'s rank or pp changes.\nSettings:\n`Ping`: `{'Yes' if ping else 'No'}`\n`Global Rank Threshold`: `{GlobalRankThreshold}`\n`Country Rank Threshold`: `{CountryRankThreshold}`\n`PP Threshold`: `{PPThreshold}`")
 
-        if message.content.lower() == "ss!list":
-            # Read the player data
-            with open("SSData.json", "r+") as f:
-                FullData = json.loads(f.read())
-            # Create a list of players in this channel
-            registered = []
-            for RegisteredPlayer in FullData:
-                if RegisteredPlayer["channelId"] == message.channel.id and RegisteredPlayer["discordUserId"] == message.author.id:
-                    registered.append(RegisteredPlayer)
-            embeds = []
-            if len(registered) > 0:
-                text = ""
-                # Create a list of embeds to send with player profile links and data
-                for Player in registered:
-                    playerText = f"#{str(Player['playerInfo']['rank'])} :flag_{Player['playerInfo']['country'].lower()}:[{Player['playerInfo']['playerName']}](https://scoresaber.com/u/{Player['playerInfo']['playerId']}) | {str(Player['playerInfo']['pp'])}pp\n"
-                    if len(text + playerText) < 2000:
-                        text += playerText
-                    else:
-                        embeds.append(GetEmbed("Registered users in this channel", text))
-                        text = playerText
-                embeds.append(GetEmbed("Registered users in this channel", text))
-                # Send the embeds to the channel
-                for embed in embeds:
-                    await asyncio.sleep(1)
-                    await message.channel.send(content="", embed=embed)
+# Unregister command
+async def CommandUnregister(message, splitcontent):
+    # If no name, id, or url was provided
+    if len(splitcontent) < 2:
+        await message.channel.send("Please provide a ScoreSaber Name, UID, or URL!\nExamples: `SS!UnRegister https://scoresaber.com/u/76561198333869741`\n`SS!UnRegsiter Taichidesu`")
+        return
+    # Get player stats on everything after the command
+    try:
+        playerId = await GetSSPlayerID(' '.join(splitcontent[1:]))
+    except KeyError:
+        await message.channel.send("That player doesn't exist!")
+        return
+    # Remove the player in this channel by this user with the given player id
+    RegisteredPlayer = await Registry.Remove(message.channel.id, message.author.id, playerId)
+    if RegisteredPlayer is None:
+        await message.channel.send("That player is not registered in this channel!")
+        return
+    await message.channel.send(f"{message.author.mention} You will no longer get notified in this channel when {RegisteredPlayer['playerInfo'].name}'s rank or pp changes.")
+
+# List the players registered by a user in a channel
+async def CommandList(message, splitcontent):
+    # Get the players this user registered in this channel
+    registered = Registry.GetByChannelUser(message.channel.id, message.author.id)
+    embeds = []
+    if len(registered) > 0:
+        text = ""
+        # Create a list of embeds to send with player profile links and data
+        for Player in registered:
+            snapshot = Player["playerInfo"]
+            playerText = f"#{snapshot.rank} :flag_{snapshot.country.lower()}:[{snapshot.name}](https://scoresaber.com/u/{snapshot.id}) | {snapshot.pp}pp\n"
+            if len(text + playerText) < 2000:
+                text += playerText
             else:
-                await message.channel.send("No registered users in this channel!")
+                embeds.append(GetEmbed("Registered users in this channel", text))
+                text = playerText
+        embeds.append(GetEmbed("Registered users in this channel", text))
+        # Send the embeds to the channel
+        for embed in embeds:
+            await asyncio.sleep(1)
+            await message.channel.send(content="", embed=embed)
+    else:
+        await message.channel.send("No registered users in this channel!")
+
+# Show how a player's stats changed over the last days, from the history only
+async def CommandHistory(message, splitcontent):
+    if len(splitcontent) < 2:
+        await message.channel.send("Please provide a ScoreSaber Name, UID, or URL!\nExamples: `SS!History https://scoresaber.com/u/76561198161040596 30`\n`SS!History Taichidesu`")
+        return
+    # The amount of days is optional, and always last
+    days = 7
+    ssplayer = ' '.join(splitcontent[1:])
+    if len(splitcontent) > 2:
+        try:
+            days = int(splitcontent[-1])
+            ssplayer = ' '.join(splitcontent[1:-1])
+        except:
+            pass
+    if days < 1:
+        await message.channel.send("Please provide a valid amount of days!")
+        return
+    # Nothing is changed, so the start of a name is good enough if only one known name starts with it
+    playerId = GetTrackedPlayerID(ssplayer) or await Names.Resolve(ssplayer, prefix=True)
+    samples = [] if playerId is None else await History.Get(playerId, time.time() - days * 86400)
+    if not samples:
+        await message.channel.send("No history for that player! Only players registered in any channel are tracked.")
+        return
+    player = LatestPlayers[playerId]
+    first, last = samples[0], samples[-1]
+    ranks = [sample[1] for sample in samples]
+    countryRanks = [sample[2] for sample in samples]
+    pps = [round(sample[3], 2) for sample in samples]
+    # + if it improved, - if it got worse
+    GlobalIndicator = "+" if last[1] < first[1] else "-" if last[1] > first[1] else ""
+    CountryIndicator = "+" if last[2] < first[2] else "-" if last[2] > first[2] else ""
+    PPIndicator = "+" if pps[-1] > pps[0] else "-" if pps[-1] < pps[0] else ""
+    text = f"Global Rank: `#{first[1]}>#{last[1]}` (`{GlobalIndicator}{abs(last[1] - first[1])}`), best `#{min(ranks)}`, worst `#{max(ranks)}`\n"
+    text += f"Country Rank (:flag_{player.country.lower()}:{player.country}): `#{first[2]}>#{last[2]}` (`{CountryIndicator}{abs(last[2] - first[2])}`), best `#{min(countryRanks)}`, worst `#{max(countryRanks)}`\n"
+    text += f"PP: `{pps[0]}pp>{pps[-1]}pp` (`{PPIndicator}{abs(round(pps[-1] - pps[0], 2))}`), lowest `{min(pps)}pp`, highest `{max(pps)}pp`\n"
+    text += f"`{len(samples)}` samples since <t:{first[0]}:f>"
+    await message.channel.send(content="", embed=GetEmbed(f"Last {days} days", text).set_author(name=player.name, url=f"https://scoresaber.com/u/{player.id}", icon_url=player.avatar).set_footer(icon_url=ProfilePicture, text=f"ID: {player.id}"))
+
+# Get the players near a leaderboard position
+async def CommandLeaderboard(message, splitcontent):
+    if len(splitcontent) < 2:
+        await message.channel.send(f"Please provide a global leaderboard position!\nExample: `SS!Leaderboard 25`")
+        return
+    try:
+        rank = int(splitcontent[1])
+        if rank < 1:
+            await message.channel.send("Please provide a valid rank!")
             return
+    except:
+        await message.channel.send("Please provide a valid rank!")
+        return
+    # Everyone asking about the same rank at the same time shares one lookup
+    text = await CollapseCommand(("leaderboard", rank), lambda: GetLeaderboardText(rank))
+    try:
+        # Send the message as an embed
+        await message.channel.send(content="", embed=GetEmbed(f"Leaderboard near {rank}", text))
+    except:
+        # If the message was too long or discord doesn't like it
+        await message.channel.send("Mesage could not be sent!")
 
-        if message.content.lower().startswith("ss!leaderboard"):
-            splitcontent = message.content.split(" ")
-            if len(splitcontent) < 2:
-                await message.channel.send(f"Please provide a global leaderboard position!\nExample: `SS!Leaderboard 25`")
-                return
-            try:
-                rank = int(splitcontent[1])
-                if rank < 1:
-                    await message.channel.send("Please provide a valid rank!")
-                    return
-            except:
-                await message.channel.send("Please provide a valid rank!")
-                return
-            # Get the leaderboard the user requested for
-            url = f"https://new.scoresaber.com/api/players/{str(GetScoreBoardNum(rank))}"
-            leaderBoard = json.loads(ApiCall(url))
-            # If rank is greater than or equal to 7.
-            # Because if it's 4 for example, rank - 5 would give -1 rank position, and thus -1 leaderboard. Requesting that errors.
-            if rank >= 7:
-                # If rank - 5 is on a different leaderboard number
-                if GetScoreBoardNum(rank - 5) != GetScoreBoardNum(rank):
-                    # Get that leaderboard
-                    url = f"https://new.scoresaber.com/api/players/{GetScoreBoardNum(rank - 5)}"
-                    tmpLeaderBoard = json.loads(ApiCall(url))
-                    # Add the first leaderboard to the end of the new one
-                    tmpLeaderBoard["players"].extend(leaderBoard["players"])
-                    # Set the old leaderboard to the new one
-                    leaderBoard = tmpLeaderBoard
-                # If rank + 5 is on a different leaderboard number
-                elif GetScoreBoardNum(rank + 5) != GetScoreBoardNum(rank):
-                    # Get that leaderboard
-                    url = f"https://new.scoresaber.com/api/players/{GetScoreBoardNum(rank + 5)}"
-                    tmpLeaderBoard = json.loads(ApiCall(url))
-                    # Add the new leaderboard to the end of the old one
-                    leaderBoard["players"].extend(tmpLeaderBoard["players"])
-            # Create the list of people near that leaderboard position
+# Gets the SS!Leaderboard text for the players near a rank, from the leaderboard index where it can
+async def GetLeaderboardText(rank):
+    players, updated = await Leaderboard.Around(rank, 5)
+    text = ""
+    for player in players:
+        # If the requested rank is this player
+        heretext = "**HERE** -> " if player["rank"] == rank else ""
+        text += f"{heretext}#{player['rank']} :flag_{player['country'].lower()}:[{player['playerName']}](https://scoresaber.com/u/{player['playerId']}) | {player['pp']}pp\n"
+    # Add the leaderboard page link, and how old the list is
+    text += f"\n[Leaderboard Page](https://scoresaber.com/global/{GetScoreBoardNum(rank)})\nUpdated <t:{int(updated)}:R>"
+    return text
+
+# Changelog command
+async def CommandChangelog(message, splitcontent):
+    # If no version tag was given
+    if len(splitcontent) == 1:
+        await message.channel.send(content="", embed=GetEmbed(f"Changelog for {Changelog['Latest']}", Changelog[Changelog['Latest']]))
+    else:
+        # If a version tag was given, check if it exists
+        if splitcontent[1] in Changelog.keys():
+            # Send the changelog
+            await message.channel.send(content="", embed=GetEmbed(f"Changelog for {splitcontent[1]}", Changelog[splitcontent[1]]))
+        else:
+            # If the tag doesn't exist
             text = ""
-            heretext = ""
-            # For every player in the grabbed leaderboards
-            for player in leaderBoard["players"]:
-                # Check if the player rank is within 5 of the given rank
-                # This gives us 9 total players, with the requested one being in the middle
-                if not CheckThreshold(int(player["rank"]), rank, 5):
-                    # If the requested rank is this player
-                    if player["rank"] == rank:
-                        heretext = "**HERE** -> "
-                    text += f"{heretext}#{player['rank']} :flag_{player['country'].lower()}:[{player['playerName']}](https://scoresaber.com/u/{player['playerId']}) | {player['pp']}pp\n"
-                    heretext = ""
-            # Add the leaderboard page link
-            text += f"\n[Leaderboard Page](https://scoresaber.com/global/{GetScoreBoardNum(rank)})"
+            # Generate the versions list
+            for version in Changelog.keys():
+                if version == "Latest":
+                    continue
+                text += f"`{version}` "
+            # Send the list of versions
+            await message.channel.send(f"Not a valid version!\nVersions:\n{text}")
+
+# Every command by name, with whether it spends ScoreSaber API requests (and has a cooldown)
+Commands = {
+    "stats": (CommandStats, False),
+    "license": (CommandLicense, False),
+    "help": (CommandHelp, False),
+    "info": (CommandInfo, True),
+    "register": (CommandRegister, True),
+    "unregister": (CommandUnregister, True),
+    "list": (CommandList, False),
+    "history": (CommandHistory, False),
+    "leaderboard": (CommandLeaderboard, True),
+    "changelog": (CommandChangelog, False)
+}
+
+# Sharded, so guilds are spread over several gateway connections once the bot is in too many for one
+class MyClient(discord.AutoShardedClient):
+
+    # Owner of the bot application, the only one allowed to use SS!Stats
+    OwnerId = None
+    # Poller worker processes started by the bot
+    PollWorkers = []
+
+    async def close(self):
+        for worker in self.PollWorkers:
+            worker.terminate()
+        # Only once the state was restored, or the state from before the restart would be overwritten with nothing
+        if StateRestore is not None and StateRestore.done():
             try:
-                # Send the message as an embed
-                await message.channel.send(content="", embed=GetEmbed(f"Leaderboard near {rank}", text))
-            except:
-                # If the message was too long or discord doesn't like it
-                await message.channel.send("Mesage could not be sent!")
-                return
+                await SaveState()
+            except Exception as ex:
+                print(ex)
+        await CloseHttpSession()
+        await super().close()
 
-        if message.content.lower().startswith("ss!changelog"):
-            splitcontent = message.content.split(" ")
-            # If no version tag was given
-            if len(splitcontent) == 1:
-                await message.channel.send(content="", embed=GetEmbed(f"Changelog for {Changelog['Latest']}", Changelog[Changelog['Latest']]))
-            else:
-                # If a version tag was given, check if it exists
-                if splitcontent[1] in Changelog.keys():
-                    # Send the changelog
-                    await message.channel.send(content="", embed=GetEmbed(f"Changelog for {splitcontent[1]}", Changelog[splitcontent[1]]))
-                else:
-                    # If the tag doesn't exist
-                    text = ""
-                    # Generate the versions list
-                    for version in Changelog.keys():
-                        if version == "Latest":
-                            continue
-                        text += f"`{version}` "
-                    # Send the list of versions
-                    await message.channel.send(f"Not a valid version!\nVersions:\n{text}")
+    async def on_ready(self):
+        global StatUpdateRunning
+        global StatusUpdateRunning
+        print(f"Logged in as {str(self.user)}")
+        if not StatUpdateRunning:
+            bg_task = client.loop.create_task(StatUpdateRoutine())
+        if not StatusUpdateRunning:
+            bg_task2 = client.loop.create_task(StatusUpdateRoutine())
+        if not MetricsRunning:
+            bg_task3 = client.loop.create_task(MetricsRoutine())
+        if not LeaderboardRunning:
+            bg_task4 = client.loop.create_task(LeaderboardRoutine())
+        if self.OwnerId is None:
+            self.OwnerId = (await self.application_info()).owner.id
+
+    async def on_message(self, message):
+        # If any bot sends a message, or the message is not a command
+        if message.author.bot or not message.content.lower().startswith("ss!"):
             return
+        # Split the message once, the command is looked up instead of checking every command
+        splitcontent = message.content.split(" ")
+        command = splitcontent[0].lower()[3:]
+        if command not in Commands:
+            return
+        handler, UsesApi = Commands[command]
+        if UsesApi:
+            wait = Cooldowns.Check(command, message.author.id, message.channel.id)
+            if wait > 0:
+                Metrics.Count("commands_cooldown_total", (("command", command),))
+                await message.channel.send(f"Slow down! You can use this command again in {int(wait) + 1} seconds.")
+                return
+            reservation = Cooldowns.Reserve(command, message.author.id, message.channel.id)
+            CommandUse.set(reservation)
+        # Time every command
+        start = time.monotonic()
+        try:
+            await handler(message, splitcontent)
+        finally:
+            Metrics.Observe("command_seconds", time.monotonic() - start, (("command", command),))
+            if UsesApi:
+                Cooldowns.Refund(reservation)
 
-client = MyClient()
-client.run(Token)
+client = MyClient(shard_count=ShardCount)
+# Only start the bot when run directly, the benchmarks import this file
+if __name__ == "__main__":
+    # python3 ScoreSaber-Stats-Bot.py --poll-worker <name> polls a share of the players without connecting to Discord
+    if "--poll-worker" in sys.argv:
+        IsPollWorker = True
+        WorkerName = sys.argv[sys.argv.index("--poll-worker") + 1]
+        if MetricsFile:
+            MetricsFile = f"{os.path.splitext(MetricsFile)[0]}-{WorkerName}{os.path.splitext(MetricsFile)[1]}"
+        if StatePath:
+            StatePath = f"{os.path.splitext(StatePath)[0]}-{WorkerName}{os.path.splitext(StatePath)[1]}"
+        # The bot stops its workers with SIGTERM, exit normally so the state gets saved
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        try:
+            client.loop.run_until_complete(PollWorkerMain())
+        finally:
+            if StatePath and StateRestore is not None and StateRestore.done():
+                WriteState(StatePath, GetState())
+    else:
+        client.run(Token)
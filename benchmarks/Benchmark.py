@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+# Offline benchmarks for the ScoreSaber Stats Bot
+# Runs the poller and commands against a local ScoreSaber stand-in and a fake Discord, with synthetic registrations
+# Usage: python3 benchmarks/Benchmark.py [--sizes 1000 10000 100000] [--latency 0.05] [--rate 0] [--no-etags] [--commands 200] [--json]
+import argparse
+import asyncio
+import importlib.util
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from FakeDiscord import FakeDiscord, FakeMessage, FakeUser
+from MockScoreSaber import MockScoreSaber
+
+Root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+# Makes a list of registrations in the old SSData.json layout, which the bot migrates on startup
+# Every player is registered about 3 times, and half of them are in the top 5000 like most communities
+def GenerateRegistrations(mock, size, rng):
+    PlayerCount = max(1, size // 3)
+    top = mock.Players[:5000]
+    tracked = [rng.choice(top) if n % 2 == 0 else rng.choice(mock.Players) for n in range(PlayerCount)]
+    registrations = []
+    for n in range(size):
+        player = tracked[n % PlayerCount]
+        registrations.append({"playerInfo": dict(player, avatar="https://new.scoresaber.com" + player["avatar"]), "channelId": 1000 + n % max(1, size // 10), "discordUserId": 5000 + n % 997, "ping": n % 2 == 0, "globalRankThreshold": 1, "countryRankThreshold": 1, "ppThreshold": 0.01})
+    return registrations
+
+
+# Imports the bot from a directory holding its Settings.json, without starting it
+def ImportBot(directory):
+    os.chdir(directory)
+    spec = importlib.util.spec_from_file_location("ScoreSaberStatsBot", os.path.join(Root, "ScoreSaber-Stats-Bot.py"))
+    bot = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(bot)
+    return bot
+
+
+def Percentile(values, q):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+# Waits until every queued stat update message has been sent
+async def Drain(bot):
+    while bot.Delivery.Queues:
+        await asyncio.sleep(0.01)
+
+
+# Polls every tracked player once and measures it
+async def RunCycle(bot, mock):
+    for state in bot.Poller.Players.values():
+        state[0] = 0
+    mock.ResetCounts()
+    tracemalloc.reset_peak()
+    start = time.monotonic()
+    await bot.SendStatUpdates()
+    await Drain(bot)
+    return {"seconds": round(time.monotonic() - start, 3), "apiCalls": dict(mock.Requests), "ratelimited": mock.Ratelimited, "notModified": mock.NotModified, "peakMemoryMB": round(tracemalloc.get_traced_memory()[1] / 1048576, 1)}
+
+
+# Sends commands while a poll is running and measures how long each one takes to handle
+async def RunCommands(bot, mock, discord, count, rng):
+    tracked = list(bot.Registry.ByPlayer.keys())
+    users = list({key[:2] for key in bot.Registry.ByKey})
+    latencies = {}
+    poll = asyncio.get_event_loop().create_task(RunCycle(bot, mock))
+    for n in range(count):
+        kind = ["register", "leaderboard", "list", "info"][n % 4]
+        channelId, userId = rng.choice(users)
+        if kind == "register":
+            content, channelId, userId = f"ss!register {rng.choice(tracked)}", 900000 + n, 800000 + n
+        elif kind == "leaderboard":
+            content = f"ss!leaderboard {rng.randint(1, 5000)}"
+        elif kind == "list":
+            content = "ss!list"
+        else:
+            content = f"ss!info {rng.choice(tracked)}"
+        message = FakeMessage(content, FakeUser(userId), discord.get_channel(channelId))
+        start = time.monotonic()
+        await bot.client.on_message(message)
+        latencies.setdefault(kind, []).append(time.monotonic() - start)
+    await poll
+    return {kind: {"p50ms": round(Percentile(values, 0.5) * 1000, 2), "p99ms": round(Percentile(values, 0.99) * 1000, 2)} for kind, values in latencies.items()}
+
+
+# Benchmarks a single registration set size, meant to run in its own process
+async def RunSize(size, args):
+    rng = random.Random(size)
+    mock = MockScoreSaber(max(20000, size), args.latency, args.rate, ETags=not args.no_etags)
+    await mock.Start()
+    directory = tempfile.mkdtemp(prefix="ssbench")
+    with open(os.path.join(Root, "Settings.Template"), "r") as f:
+        Settings = json.loads(f.read())
+    Settings.update({"ApiBaseURL": mock.URL, "ApiRequestsPerMinute": 10 ** 9, "ApiBurst": 10 ** 6, "PollWindow": 0, "CommandCooldownUser": 0, "CommandCooldownChannel": 0, "MetricsFile": "", "DatabasePath": os.path.join(directory, "SSData.db")})
+    with open(os.path.join(directory, "Settings.json"), "w") as f:
+        f.write(json.dumps(Settings))
+    with open(os.path.join(directory, "SSData.json"), "w") as f:
+        f.write(json.dumps(GenerateRegistrations(mock, size, rng)))
+    tracemalloc.start()
+    start = time.monotonic()
+    bot = ImportBot(directory)
+    startup = round(time.monotonic() - start, 3)
+    discord = FakeDiscord(args.discord_latency)
+    bot.client.get_channel = discord.get_channel
+    bot.client.OwnerId = 0
+    # First poll, nothing is known about anyone yet
+    cold = await RunCycle(bot, mock)
+    # Second poll, after some players have played
+    mock.Shuffle(0.05)
+    warm = await RunCycle(bot, mock)
+    warm["messages"] = discord.SentCount()
+    warm["updates"] = discord.EmbedCount()
+    # Third poll, nobody played since the second
+    idle = await RunCycle(bot, mock)
+    commands = await RunCommands(bot, mock, discord, args.commands, rng)
+    await bot.CloseHttpSession()
+    await mock.Stop()
+    return {"registrations": size, "players": len(bot.Registry.ByPlayer), "startupSeconds": startup, "coldCycle": cold, "warmCycle": warm, "idleCycle": idle, "commands": commands}
+
+
+def PrintResult(result):
+    print(f"{result['registrations']} registrations, {result['players']} players (startup {result['startupSeconds']}s)")
+    for name in ("coldCycle", "warmCycle", "idleCycle"):
+        cycle = result[name]
+        calls = ", ".join(f"{endpoint} {count}" for endpoint, count in sorted(cycle["apiCalls"].items()))
+        print(f"  {name}: {cycle['seconds']}s, API calls: {sum(cycle['apiCalls'].values())} ({calls}), 429s: {cycle['ratelimited']}, 304s: {cycle['notModified']}, peak memory: {cycle['peakMemoryMB']}MB")
+        if "messages" in cycle:
+            print(f"  {name}: {cycle['updates']} stat updates in {cycle['messages']} Discord messages")
+    for kind, latency in sorted(result["commands"].items()):
+        print(f"  ss!{kind}: p50 {latency['p50ms']}ms, p99 {latency['p99ms']}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline ScoreSaber Stats Bot benchmarks")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000], help="Registration set sizes to benchmark")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds the ScoreSaber stand-in delays every response by")
+    parser.add_argument("--rate", type=int, default=0, help="Requests per second the ScoreSaber stand-in allows, 0 for no limit")
+    parser.add_argument("--no-etags", action="store_true", help="Don't send ETags from the ScoreSaber stand-in")
+    parser.add_argument("--discord-latency", type=float, default=0.0, help="Seconds every Discord message takes to send")
+    parser.add_argument("--commands", type=int, default=200, help="Commands sent during the last poll")
+    parser.add_argument("--json", action="store_true", help="Print results as JSON")
+    parser.add_argument("--single", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.single is not None:
+        print(json.dumps(asyncio.run(RunSize(args.single, args))))
+        return
+    # Every size runs in its own process, so memory and module state don't carry over
+    results = []
+    for size in args.sizes:
+        command = [sys.executable, os.path.abspath(__file__), "--single", str(size), "--latency", str(args.latency), "--rate", str(args.rate), "--discord-latency", str(args.discord_latency), "--commands", str(args.commands)] + (["--no-etags"] if args.no_etags else [])
+        output = subprocess.run(command, check=True, stdout=subprocess.PIPE, text=True).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        results.append(result)
+        if not args.json:
+            PrintResult(result)
+    if args.json:
+        print(json.dumps(results, indent=4))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+# Just enough of Discord for the bot to send messages to and receive commands from, used by the benchmarks
+import asyncio
+
+
+class FakeUser:
+    def __init__(self, userId):
+        self.id = userId
+        self.bot = False
+        self.mention = f"<@{userId}>"
+
+
+class FakeChannel:
+    def __init__(self, channelId, Latency=0.0):
+        self.id = channelId
+        self.type = "text"
+        self.Latency = Latency
+        # (content, embeds) of every message sent here
+        self.Sent = []
+
+    async def send(self, content=None, embed=None, embeds=None):
+        if self.Latency:
+            await asyncio.sleep(self.Latency)
+        self.Sent.append((content, embeds if embeds is not None else [embed] if embed is not None else []))
+
+
+class FakeMessage:
+    def __init__(self, content, author, channel):
+        self.content = content
+        self.author = author
+        self.channel = channel
+
+
+# Stands in for the parts of discord.Client the poller uses
+class FakeDiscord:
+    def __init__(self, Latency=0.0):
+        self.Latency = Latency
+        self.Channels = {}
+
+    def get_channel(self, channelId):
+        channel = self.Channels.get(channelId)
+        if channel is None:
+            channel = self.Channels[channelId] = FakeChannel(channelId, self.Latency)
+        return channel
+
+    def SentCount(self):
+        return sum(len(channel.Sent) for channel in self.Channels.values())
+
+    # Stat update embeds sent, some messages carry several
+    def EmbedCount(self):
+        return sum(len(embeds) for channel in self.Channels.values() for content, embeds in channel.Sent)
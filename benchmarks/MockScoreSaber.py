@@ -0,0 +1,128 @@
+# Local stand-in for the ScoreSaber API, used by the benchmarks
+# Serves /api/player/{id}/basic, /api/players/{page} and /api/players/by-name/{name} from a generated leaderboard
+import asyncio
+import hashlib
+import json
+import random
+import time
+from aiohttp import web
+
+Countries = ["US", "GB", "DE", "NL", "JP", "KR", "CA", "AU", "FR", "SE", "PL", "BR"]
+
+
+class MockScoreSaber:
+    def __init__(self, PlayerCount, Latency=0.0, RequestsPerSecond=0, Seed=0, ETags=True):
+        self.Random = random.Random(Seed)
+        # Seconds every response is delayed by
+        self.Latency = Latency
+        # Requests allowed per second before answering with 429, 0 for no limit
+        self.RequestsPerSecond = RequestsPerSecond
+        # Whether /basic responses come with an ETag
+        self.ETags = ETags
+        self.WindowStart = time.monotonic()
+        self.WindowRequests = 0
+        # endpoint: amount of requests
+        self.Requests = {}
+        self.Ratelimited = 0
+        self.NotModified = 0
+        self.Players = []
+        for n in range(PlayerCount):
+            playerId = str(76561198000000000 + n)
+            self.Players.append({"playerId": playerId, "playerName": f"Player{n}", "avatar": f"/api/static/avatars/{playerId}.jpg", "rank": 0, "countryRank": 0, "pp": round(20000 / (1 + n / 50) + self.Random.random(), 2), "country": self.Random.choice(Countries), "role": None, "badges": [], "history": "", "permissions": 0, "inactive": 0, "banned": 0})
+        self.ById = {player["playerId"]: player for player in self.Players}
+        self.ByName = {player["playerName"].lower(): player for player in self.Players}
+        self.Rerank()
+        self.Runner = None
+        self.URL = None
+
+    # Sorts the leaderboard by pp and hands out global and country ranks
+    def Rerank(self):
+        self.Players.sort(key=lambda player: -player["pp"])
+        CountryRanks = {}
+        for n, player in enumerate(self.Players):
+            player["rank"] = n + 1
+            CountryRanks[player["country"]] = CountryRanks.get(player["country"], 0) + 1
+            player["countryRank"] = CountryRanks[player["country"]]
+
+    # Gives a fraction of all players some pp, like they've been playing since the last poll
+    def Shuffle(self, fraction):
+        for player in self.Random.sample(self.Players, int(len(self.Players) * fraction)):
+            player["pp"] = round(player["pp"] + self.Random.uniform(0.5, 50), 2)
+        self.Rerank()
+
+    def ResetCounts(self):
+        self.Requests = {}
+        self.Ratelimited = 0
+        self.NotModified = 0
+
+    # Counts a request, returns a 429 response if it goes over the ratelimit
+    async def Handle(self, endpoint):
+        if self.Latency:
+            await asyncio.sleep(self.Latency)
+        if self.RequestsPerSecond:
+            now = time.monotonic()
+            if now - self.WindowStart >= 1:
+                self.WindowStart = now
+                self.WindowRequests = 0
+            self.WindowRequests += 1
+            if self.WindowRequests > self.RequestsPerSecond:
+                self.Ratelimited += 1
+                return web.Response(status=429, headers={"Retry-After": "1"}, text=json.dumps({"error": {"message": "Too Many Requests"}}))
+        self.Requests[endpoint] = self.Requests.get(endpoint, 0) + 1
+        return None
+
+    def Error(self):
+        return web.Response(status=404, text=json.dumps({"error": {"message": "Player not found"}}), content_type="application/json")
+
+    # The leaderboard layout of a player, leaderboards don't list country rank or status
+    def Listing(self, player):
+        return {"playerId": player["playerId"], "playerName": player["playerName"], "avatar": player["avatar"], "rank": player["rank"], "pp": player["pp"], "country": player["country"], "history": "", "difference": 0}
+
+    async def Basic(self, request):
+        response = await self.Handle("basic")
+        if response is not None:
+            return response
+        player = self.ById.get(request.match_info["playerId"])
+        if player is None:
+            return self.Error()
+        text = json.dumps({"playerInfo": dict(player), "scoreStats": {"totalScore": 0, "totalRankedScore": 0, "averageRankedAccuracy": 0, "totalPlayCount": 0, "rankedPlayCount": 0}})
+        # Answers conditional requests like a server that sends ETags would, unless told not to
+        if not self.ETags:
+            return web.Response(text=text, content_type="application/json")
+        etag = '"' + hashlib.md5(text.encode()).hexdigest() + '"'
+        if request.headers.get("If-None-Match") == etag:
+            self.NotModified += 1
+            return web.Response(status=304, headers={"ETag": etag})
+        return web.Response(text=text, content_type="application/json", headers={"ETag": etag})
+
+    async def Page(self, request):
+        response = await self.Handle("players")
+        if response is not None:
+            return response
+        page = int(request.match_info["page"])
+        return web.json_response({"players": [self.Listing(player) for player in self.Players[(page - 1) * 50:page * 50]]})
+
+    async def ByNameSearch(self, request):
+        response = await self.Handle("by-name")
+        if response is not None:
+            return response
+        player = self.ByName.get(request.match_info["name"].lower())
+        if player is None:
+            return self.Error()
+        return web.json_response({"players": [self.Listing(player)]})
+
+    # Starts serving on a random local port, the base url ends up in self.URL
+    async def Start(self):
+        app = web.Application()
+        app.router.add_get("/api/player/{playerId}/basic", self.Basic)
+        app.router.add_get("/api/players/by-name/{name}", self.ByNameSearch)
+        app.router.add_get("/api/players/{page:\\d+}", self.Page)
+        self.Runner = web.AppRunner(app, access_log=None)
+        await self.Runner.setup()
+        site = web.TCPSite(self.Runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.URL = f"http://127.0.0.1:{port}"
+
+    async def Stop(self):
+        await self.Runner.cleanup()